@@ -11,11 +11,13 @@ def Start():
 ### Pre-Defined ValidatePrefs function Values in "DefaultPrefs.json", accessible in Settings>Tab:Plex Media Server>Sidebar:Agents>Tab:Movies/TV Shows>Tab:AmsaTV #######
 def ValidatePrefs(): #     a = sum(getattr(t, name, 0) for name in "xyz")
     DefaultPrefs = ("GetTvdbFanart", "GetTvdbPosters", "GetTvdbBanners", "GetAnidbPoster", "localart", "adult", 
-                  "GetPlexThemes", "MinimumWeight", "SerieLanguage1", "SerieLanguage2", "SerieLanguage3", 
+                  "GetPlexThemes", "MinimumWeight", "CacheSizeLimit", "CompressCache", "BatchResolvePath", "SerieLanguage1", "SerieLanguage2", "SerieLanguage3", 
                   "AgentPref1", "AgentPref2", "AgentPref3", "EpisodeLanguage1", "EpisodeLanguage2")
     try: [Prefs[key] for key in DefaultPrefs]
     except: Log.Error("Init - ValidatePrefs() - DefaultPrefs.json invalid" );  return MessageContainer ("Error", "Value '%s' missing from 'DefaultPrefs.json', update it" % key)
-    else: Log.Info ("Init - ValidatePrefs() - DefaultPrefs.json is valid");  return MessageContainer ("Success", "AMSA - Provided preference values are ok")
+    if Prefs["BatchResolvePath"] and os.path.isdir(Prefs["BatchResolvePath"]) and common.StartResolveLibrary(Prefs["BatchResolvePath"]):
+        Log.Info("Init - ValidatePrefs() - Batch resolving library: '%s'" % Prefs["BatchResolvePath"])
+    Log.Info ("Init - ValidatePrefs() - DefaultPrefs.json is valid");  return MessageContainer ("Success", "AMSA - Provided preference values are ok")
   
   
 ### Agent declaration ###############################################################################################################################################
@@ -34,81 +36,18 @@ class AmsaTVAgent(Agent.TV_Shows):
         if orig_title.startswith("clear-cache"):   HTTP.ClearCache()
         Log.Info("Init - Search() - Show: '%s', Title: '%s', name: '%s', filename: '%s', manual:'%s'" % (media.show, orig_title, media.name, urllib2.unquote(media.filename) if media.filename else "", str(manual)))
                
-        match = re.search("(?P<show>.*?) ?\[(?P<source>(.*))-(tt)?(?P<id>[0-9]{1,7})\]", orig_title, re.IGNORECASE)
-        if match:
-            title = match.group("show")
-            source = match.group("source").lower() 
-            if source in ["anidb", "anidb2", "tvdb", "tvdb2", "tvdb3", "tvdb4", "tvdb5"]:
-                id = match.group("id")
-                startdate = None
-                if source in ["anidb", "anidb2"]:  
-                    title = functions.GetPreferedTitle(common.GetAnimeTitleByID(id))
-                Log.Debug("Init - Search() - force - id: '%s-%s', title from id: '%s' provided in foldername: '%s'" % (source, id, title, orig_title) )
-                results.Append(MetadataSearchResult(id="%s-%s" % (source, id), name=title, year=startdate, lang=Locale.Language.English, score=100))
-                return
-            else: orig_title = functions.CleanTitle(title)
-       
+        forced = common.ForcedId(orig_title)
+        if forced:
+            source, id, title = forced
+            Log.Debug("Init - Search() - force - id: '%s-%s', title from id: '%s' provided in foldername: '%s'" % (source, id, title, orig_title) )
+            results.Append(MetadataSearchResult(id="%s-%s" % (source, id), name=title, year=None, lang=Locale.Language.English, score=100))
+            return
        
-        maxi = {}
-        elite = []
-        perfectScore = []
+        match = re.search("(?P<show>.*?) ?\[(?P<source>(.*))-(tt)?(?P<id>[0-9]{1,7})\]", orig_title, re.IGNORECASE)
+        if match: orig_title = match.group("show")
         orig_title = functions.CleanTitle(orig_title)
-        @parallelize
-        def searchTitles():
-            for anime in common.GetAnimeTitleByName(orig_title):
-                @task
-                def scoreTitle(anime=anime, maxi=maxi, anidb=anidb, tvdb=tvdb, scudlee=scudlee, perfectScore=perfectScore, elite=elite, orig_title=orig_title): 
-                    anime = common.Titles(anime, orig_title)
-                    isValid = True
-                    if (anime.Id in maxi and maxi[anime.Id] <= anime.Score) or (not anime.Id in maxi):
-                        maxi[anime.Id] = anime.Score
-                    else: 
-                        isValid = False
-                    if isValid: 
-                        scoreChecked = False
-                        startdate = None
-                        if(media.year and anime.Score >= 90 and constants.SEARCH_USE_TVDB and not scoreChecked):
-                            mappingData = scudlee.ScudLee(anime.Id)
-                            show = tvdb.TvDB(mappingData.TvdbId) 
-                            if show: 
-                                try: 
-                                    startdate = dateParse(show.Originally_Available_At).year
-                                except: pass
-                                if str(startdate) != str(media.year):
-                                    isValid = False 
-                                Log.Debug("Init - Search() - TVDB - date: '%s', aired: '%s'" % (media.year, startdate)) 
-                            elite.append(isValid)
-                            scoreChecked = True
-                            
-                        if(media.year and anime.Score >= 90 and constants.SEARCH_USE_ANIDB and not scoreChecked):
-                            show = anidb.AniDB(anime.Id) 
-                            if show: 
-                                try: 
-                                    startdate = dateParse(show.Originally_Available_At).year
-                                except: pass
-                                if str(startdate) != str(media.year):
-                                    isValid = False 
-                                Log.Debug("Init - Search() - ANIDB - date: '%s', aired: '%s'" % (media.year, startdate)) 
-                            elite.append(isValid)
-                            scoreChecked = True
-                            
-                        if anime.Score >= 90 and not scoreChecked:
-                            elite.append(isValid)
-                            scoreChecked = True
-
-                        if isValid:
-                            if anime.Score == 100: perfectScore.append(anime.Id)
-                            Log.Debug("Init - Search() - find - id: '%s-%s', title: '%s', score: '%s'" % ("anidb", anime.Id, anime.Title, anime.Score))
-                            results.Append(MetadataSearchResult(id="%s-%s" % ("anidb", anime.Id), name="%s [%s-%s]" % (anime.Title, "anidb", anime.Id), year=startdate, lang=Locale.Language.English, score=anime.Score))
-        
-        if len(list(set(perfectScore))) > 1:
-            for result in results:
-                if result.score == 100:    
-                    show = anidb.AniDB(result.id.split("-")[1])
-                    if show.Type != "TV Series": 
-                        result.score = result.score - 1
-                         
-        if len(elite) > 0 and not True in elite: del results[:]
+        for id, name, year, score in common.ResolveTitle(orig_title, media.year, manual):
+            results.Append(MetadataSearchResult(id=id, name=name, year=year, lang=Locale.Language.English, score=score))
         results.Sort("score", descending=True)
         return
         
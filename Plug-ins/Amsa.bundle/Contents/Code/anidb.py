@@ -207,6 +207,7 @@ class AniDB(constants.Series):
         
             ##--------------------------------EpisodeCount-------------------------##
             self.EpisodeCount = int(GetElementText(data, "episodecount"))
+            functions.SetStartDate("anidb", id, startdate=GetElementText(data, "startdate"), type=self.Type, episodecount=self.EpisodeCount)
             
             ##--------------------------------SpecialCount-------------------------##
             self.SpecialCount = len(data.xpath("""./episodes/episode/epno[@type="2"]"""))
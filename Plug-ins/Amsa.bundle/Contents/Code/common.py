@@ -1,87 +1,281 @@
 import functions, constants
-import plex, tvdb, anidb, scudlee
+import plex, tvdb, anidb, scudlee, storage
 
 from lxml import etree
 from lxml.builder import E
 from lxml.etree import Element, SubElement, Comment
 from functions import XMLFromURL
-from datetime import timedelta  
 
-global CleanCache_WaitUntil
-CleanCache_WaitUntil = datetime.datetime.now()
-    
+import hashlib, json, threading
+from dateutil.parser import parse as dateParse
+
+global pSearchCache, pResolvePath
+pSearchCache = None
+pResolvePath = None
+pResolveRunning = threading.Lock()
+
 class Titles():   
-    def __init__(self, entry, orig_title):
-        element = entry.getparent()
-        id = element.get("aid")
-        
-        langTitle = functions.GetPreferedTitle(element).replace("`", "'")
-        matchedTitle = functions.CleanTitle(entry.text)
-        
-        if matchedTitle.lower() == orig_title.lower():
-            score = 100
-        else:      
-            score = 90 # Start word matches off at a slight defecit compared to guid matches.
+    def __init__(self, entry, id, title, score):
+        self.Entry = entry
+        self.Id = id
+        self.Title = title
+        self.Score = score       
 
-            # Remove year suffixes that can mess things up.
-            searchTitle = orig_title
-            if len(orig_title) > 8:
-                searchTitle = re.sub(r'([ ]+\(?[0-9]{4}\)?)', '', searchTitle)
+def ScoreTitles(index, entries, orig_title):
+    # Remove year suffixes and prefixes that can mess things up, once for the query rather than per candidate
+    searchTitle = orig_title
+    if len(orig_title) > 8:
+        searchTitle = re.sub(r'([ ]+\(?[0-9]{4}\)?)', '', searchTitle)
+    searchTitle = re.sub('^[Bb][Bb][Cc] ', '', searchTitle)
 
+    matched = []
+    for entry in entries:
+        matchedTitle = index.CleanTitle(entry)
+        foundTitle = None
+        if matchedTitle.lower() != orig_title.lower():
             foundTitle = matchedTitle
             if len(foundTitle) > 8:
                 foundTitle = re.sub(r'([ ]+\(?[0-9]{4}\)?)', '', foundTitle)
-
-            # Remove prefixes that can screw things up.
-            searchTitle = re.sub('^[Bb][Bb][Cc] ', '', searchTitle)
             foundTitle = re.sub('^[Bb][Bb][Cc] ', '', foundTitle)
+        matched.append((entry, foundTitle))
 
-            # Score adjustment for title distance.
-            score = score - int(30 * (1 - functions.lev_ratio(searchTitle, foundTitle)))
-    
-        #Log("Score: '%s', '%s', '%s', '%s', '%s'" % (score, functions.lev_ratio(orig_title, matchedTitle), orig_title, matchedTitle, entry.text))
-        
-        self.Entry = entry
-        self.Id = id
-        self.Title = langTitle
-        self.Score = score       
+    ratios = functions.lev_ratios(searchTitle, [foundTitle for entry, foundTitle in matched if foundTitle != None])
+    langTitles = {}
+    result = []
+    for entry, foundTitle in matched:
+        id = str(entry.Aid)
+        if not id in langTitles:
+            langTitles[id] = functions.GetPreferedTitle(index.Store.ByAid(entry.Aid)).replace("`", "'")
+        if foundTitle == None:
+            score = 100
+        else:
+            # Start word matches off at a slight defecit compared to guid matches, then adjust for title distance.
+            score = 90 - int(30 * (1 - ratios[foundTitle]))
+        result.append(Titles(entry, id, langTitles[id], score))
+    return result
 
-        
 def GetAnimeTitleByID(Id):
-    return functions.GetAnimeTitleByID(scudlee.TitleTree(), Id)
+    return scudlee.TitleStore().ByAid(Id)
     
     
-def GetAnimeTitleByName(Name): 
-    return functions.GetAnimeTitleByName(scudlee.TitleTree(), Name)  
+def GetAnimeTitleByName(Name, index): 
+    return index.Search(Name)  
        
        
+def CachedStartDate(source, id):
+    # Start date from the start-date index or a provider file already in the cache, so search can skip the fetch
+    entry = functions.GetStartDate(source, id)
+    if entry and entry.get("startdate"): return entry["startdate"]
+    if source == "tvdb":
+        data = functions.ParseFile(str(id) + ".xml", os.path.join("TvDB", str(id)), None)
+        if data is None: return None
+        functions.SetStartDate(source, id, startdate=functions.GetElementText(data, "Series/FirstAired"))
+    else:
+        data = functions.ParseFile(str(id) + ".xml", os.path.join("AniDB", str(id)), None)
+        if data is None: return None
+        episodes = functions.GetElementText(data, "episodecount")
+        functions.SetStartDate(source, id, startdate=functions.GetElementText(data, "startdate"), type=functions.GetElementText(data, "type"), episodecount=int(episodes) if episodes.isdigit() else None)
+    return functions.GetStartDate(source, id)["startdate"] or None
+
+def AnimeType(id):
+    entry = functions.GetStartDate("anidb", id)
+    if entry and entry.get("type"): return entry["type"]
+    return anidb.AniDB(id).Type
+
+def SearchCache():
+    global pSearchCache
+    if pSearchCache == None:
+        pSearchCache = storage.JsonStore(constants.SearchCacheFile)
+    return pSearchCache
+
+def SearchKey(title, year, index):
+    settings = [title, str(year), constants.SEARCH_USE_TVDB, constants.SEARCH_USE_ANIDB, constants.SERIES_LANGUAGE_PRIORITY, index.Version]
+    return hashlib.md5(json.dumps(settings)).hexdigest()
+
+def VerifyYear(anime, year):
+    isValid = True
+    startdate = None
+    show = None
+    if constants.SEARCH_USE_TVDB:
+        mappingData = scudlee.ScudLee(anime.Id)
+        aired = CachedStartDate("tvdb", mappingData.TvdbId)
+        if aired == None:
+            show = tvdb.TvDB(mappingData.TvdbId)
+            if show: aired = show.Originally_Available_At
+        if aired != None or show: 
+            try: 
+                startdate = dateParse(aired).year
+            except: pass
+            if str(startdate) != str(year):
+                isValid = False 
+            Log.Debug("Common - VerifyYear() - TVDB - date: '%s', aired: '%s'" % (year, startdate)) 
+    elif constants.SEARCH_USE_ANIDB:
+        aired = CachedStartDate("anidb", anime.Id)
+        if aired == None:
+            show = anidb.AniDB(anime.Id)
+            if show: aired = show.Originally_Available_At
+        if aired != None or show: 
+            try: 
+                startdate = dateParse(aired).year
+            except: pass
+            if str(startdate) != str(year):
+                isValid = False 
+            Log.Debug("Common - VerifyYear() - ANIDB - date: '%s', aired: '%s'" % (year, startdate)) 
+    return isValid, startdate
+
+def ResolveTitle(orig_title, year, manual=False, verified=None):
+    # Scored [id, name, year, score] matches for a cleaned title, best first, shared by search() and the batch resolver
+    # One index for the whole resolve, the refresher may swap in a new one whose rows do not line up with these candidates
+    index = scudlee.TitleIndex()
+    searchKey = SearchKey(orig_title, year, index)
+    cached = None if manual else SearchCache().Get(searchKey)
+    if cached != None:
+        Log.Debug("Common - ResolveTitle() - cache - title: '%s', year: '%s', results: '%s'" % (orig_title, year, len(cached)))
+        return cached
+    if verified == None: verified = {}
+
+    maxi = {}
+    elite = []
+    perfectScore = []
+    results = []
+    candidates = []
+    for anime in ScoreTitles(index, GetAnimeTitleByName(orig_title, index), orig_title):
+        if anime.Id in maxi and maxi[anime.Id] > anime.Score: continue
+        maxi[anime.Id] = anime.Score
+        candidates.append(anime)
+
+    def appendResult(anime, startdate):
+        if anime.Score == 100: perfectScore.append(anime.Id)
+        Log.Debug("Common - ResolveTitle() - find - id: '%s-%s', title: '%s', score: '%s'" % ("anidb", anime.Id, anime.Title, anime.Score))
+        results.append(["%s-%s" % ("anidb", anime.Id), "%s [%s-%s]" % (anime.Title, "anidb", anime.Id), startdate, anime.Score])
+
+    # Only candidates whose year has to be checked against TVDB/AniDB are worth a task, the rest are appended straight away
+    verify = []
+    for anime in candidates:
+        if year and anime.Score >= 90 and (constants.SEARCH_USE_TVDB or constants.SEARCH_USE_ANIDB):
+            verify.append(anime)
+        else:
+            if anime.Score >= 90: elite.append(True)
+            appendResult(anime, None)
+
+    # Verify the best ranked candidates a batch at a time and stop once one of them is confirmed for the year
+    verify.sort(key=lambda x: x.Score, reverse=True)
+    confirmed = []
+    failed = []
+    while verify and not confirmed:
+        batch, verify = verify[:constants.SearchVerifyLimit], verify[constants.SearchVerifyLimit:]
+        @parallelize
+        def verifyTitles():
+            for anime in batch:
+                @task
+                def verifyTitle(anime=anime, elite=elite, confirmed=confirmed, verified=verified, failed=failed): 
+                    try:
+                        if not (anime.Id, str(year)) in verified:
+                            verified[(anime.Id, str(year))] = VerifyYear(anime, year)
+                    except Exception as e:
+                        Log.Debug("Common - ResolveTitle() - verify - id: '%s-%s', failed: '%s'" % ("anidb", anime.Id, e))
+                        failed.append(anime)
+                        return
+                    isValid, startdate = verified[(anime.Id, str(year))]
+                    elite.append(isValid)
+                    if isValid:
+                        confirmed.append(anime.Id)
+                        appendResult(anime, startdate)
+
+    # Whatever was left unverified or failed to verify is still offered, just below the verified matches
+    for anime in failed + verify:
+        appendResult(Titles(anime.Entry, anime.Id, anime.Title, anime.Score - 1), None)
+    
+    if len(list(set(perfectScore))) > 1:
+        for result in results:
+            if result[3] == 100:    
+                if AnimeType(result[0].split("-")[1]) != "TV Series": 
+                    result[3] = result[3] - 1
+                     
+    if len(elite) > 0 and not True in elite: del results[:]
+    results.sort(key=lambda x: x[3], reverse=True)
+    # A failed year check would pin a partial answer for a day, so only complete results are cached
+    if len(results) > 0 and not failed:
+        SearchCache().Set(searchKey, results, constants.SearchCacheTime)
+    return results
+
+def ResolveTitles(entries):
+    # One pass over many (name, year) pairs, identical titles are resolved once and year checks are shared
+    resolved = {}
+    verified = {}
+    output = []
+    for name, year in entries:
+        try:
+            forced = ForcedId(name)
+            if forced:
+                output.append((name, year, [["%s-%s" % (forced[0], forced[1]), forced[2], None, 100]]))
+                continue
+            title = functions.CleanTitle(name)
+            if not (title, str(year)) in resolved:
+                resolved[(title, str(year))] = ResolveTitle(title, year, False, verified)
+            output.append((name, year, resolved[(title, str(year))]))
+        except Exception as e:
+            Log.Debug("Common - ResolveTitles() - Name: '%s', Exception: '%s'" % (name, e))
+            output.append((name, year, []))
+    return output
+
+def ForcedId(title):
+    match = re.search("(?P<show>.*?) ?\[(?P<source>(.*))-(tt)?(?P<id>[0-9]{1,7})\]", title, re.IGNORECASE)
+    if match and match.group("source").lower() in ["anidb", "anidb2", "tvdb", "tvdb2", "tvdb3", "tvdb4", "tvdb5"]:
+        source, id = match.group("source").lower(), match.group("id")
+        title = match.group("show")
+        if source in ["anidb", "anidb2"]:  
+            title = functions.GetPreferedTitle(GetAnimeTitleByID(id))
+        return source, id, title
+    return None
+
+def ResolveLibrary(path):
+    # Report, for every show folder under a library root, the best match and the anidb.id it would take
+    RefreshData()
+    folders = sorted([folder for folder in os.listdir(path) if os.path.isdir(os.path.join(path, folder))])
+    entries = []
+    for folder in folders:
+        match = re.search("(?P<show>.*?) ?\((?P<year>[0-9]{4})\)$", folder)
+        entries.append((match.group("show"), match.group("year")) if match else (folder, None))
+    lines = []
+    for folder, (name, year, results) in zip(folders, ResolveTitles(entries)):
+        existing = os.path.join(path, folder, "anidb.id")
+        if os.path.isfile(existing):
+            with open(existing, "r") as file: lines.append("%s\texisting anidb.id: %s" % (folder, file.read().strip()))
+        elif results:
+            id, title, startdate, score = results[0]
+            lines.append("%s\t%s\t%s\t%s" % (folder, id.split("-")[1] if id.startswith("anidb") else id, score, title))
+        else:
+            lines.append("%s\tno match" % (folder))
+    filename = "batch-resolve-%s.txt" % (re.sub(r'[^A-Za-z0-9]+', '_', os.path.basename(os.path.normpath(path))))
+    functions.SaveFile(u"\n".join(functions.safe_unicode(line) for line in lines).encode("utf-8"), filename, "", True)
+    Log.Info("Common - ResolveLibrary() - Path: '%s', Folders: '%s', Report: '%s'" % (path, len(folders), filename))
+
+def StartResolveLibrary(path):
+    # Every prefs save calls this, so only a changed path starts a run and never while another run is going
+    global pResolvePath
+    if path == pResolvePath: return False
+    if not pResolveRunning.acquire(False):
+        Log.Info("Common - StartResolveLibrary() - Batch resolve already running, skipping: '%s'" % (path))
+        return False
+    pResolvePath = path
+    thread = threading.Thread(target=RunResolveLibrary, args=(path,), name="AmsaBatchResolve")
+    thread.daemon = True
+    thread.start()
+    return True
+
+def RunResolveLibrary(path):
+    try: ResolveLibrary(path)
+    finally: pResolveRunning.release()
+
 def RefreshData():
-    global CleanCache_WaitUntil
-    if CleanCache_WaitUntil + timedelta(days=3) < datetime.datetime.now(): 
-        CleanCache()
-    scudlee.CorrectionsTree()
-    scudlee.TitleTree()
-    scudlee.MappingTree()
+    # Only loads what has never been loaded, expired data is rebuilt and swapped in by the refresher thread
+    storage.Manager().Start()
+    scudlee.Refresher().Start()
+    scudlee.TitleIndex()
+    scudlee.MappingIndex()
     scudlee.CollectionTree()
     
-    
-def CleanCache():
-    global CleanCache_WaitUntil
-    CleanCache_WaitUntil = datetime.datetime.now()
-    for root, dirs, _  in os.walk(constants.CachePath, topdown=False):
-        for directory in dirs:
-            directory = os.path.join(root, directory)
-            for file in os.listdir(directory):
-                file = os.path.join(directory, file)
-                if os.path.isfile(file) and os.stat(file).st_mtime < time.time() - 30 * 86400:
-                    os.remove(file)   
-                    Log.Debug("Common - CleanCache() - file: '%s'" % (file))
-            try: 
-                if root.strip("\\\\?\\") != constants.CachePath: 
-                    os.rmdir(directory)   
-                    Log.Debug("Common - CleanCache() - directory: '%s'" % (directory)) 
-            except: pass  
-
             
 def ExportMap(map, filename):
     data = copy.deepcopy(map)
@@ -164,24 +358,26 @@ def MapSeries(mappingData):
                     for i in range(season.Start, season.End + 1):
                         status = "scudlee missing" 
                         tvdbParse = tvdb.ParseNoFromSeason(0, 0, ScudLee.DefaultTvdbSeason) 
-                        if not mapping.xpath("""./Series/Episode[@tvdb="S%sE%s"]""" % (season.TvdbSeason, str(i + int(season.Offset)))):
+                        if not mapping.xpath("""./Series/Episode[@tvdb="S%sE%s"]""" % (season.TvdbSeason, str(i + season.OffsetNo))):
                             status = ""
-                            tvdbParse = tvdb.ParseNoFromSeason(int(season.TvdbSeason), i + int(season.Offset), ScudLee.DefaultTvdbSeason)
-                        SubElement(seriesMap, "Episode", anidb="%s" % (anidb.ParseNoFromSeason(int(season.AnidbSeason), i)), tvdb=tvdbParse, status=status)    
-                        Log("Common - MapSeries() - Season - AniDB: '%s', TvDB: '%s'" % (anidb.ParseNoFromSeason(int(season.AnidbSeason), i), tvdbParse))
+                            tvdbParse = tvdb.ParseNoFromSeason(season.TvdbSeasonNo, i + season.OffsetNo, ScudLee.DefaultTvdbSeason)
+                        anidbParse = anidb.ParseNoFromSeason(season.AnidbSeasonNo, i)
+                        SubElement(seriesMap, "Episode", anidb="%s" % (anidbParse), tvdb=tvdbParse, status=status)    
+                        Log("Common - MapSeries() - Season - AniDB: '%s', TvDB: '%s'" % (anidbParse, tvdbParse))
                             
-                if season.Text != None:
-                    for string in filter(None, season.Text.split(";")):
-                        for i in range(0, len(string.split("-")[1].split("+"))):
-                            status = "scudlee missing"
-                            tvdbParse = tvdb.ParseNoFromSeason(0, 0, ScudLee.DefaultTvdbSeason)
-                            if not mapping.xpath("""./Series/Episode[@tvdb="S%sE%s"]""" % (season.TvdbSeason, string.split("-")[1].split("+")[i].zfill(2))) and "S%sE%s" % (season.TvdbSeason, string.split("-")[1].split("+")[i].zfill(2)) != "S00E00":
-                                status = ""
-                                tvdbParse = tvdb.ParseNoFromSeason(int(season.TvdbSeason), int(string.split("-")[1].split("+")[i]), ScudLee.DefaultTvdbSeason)
-                            elif not mapping.xpath("""./Series/Episode[@tvdb="S%sE%s"]""" % (season.TvdbSeason, string.split("-")[1].split("+")[i].zfill(2))):
-                                status = "tvdb missing"
-                            SubElement(seriesMap, "Episode", anidb="%s" % (anidb.ParseNoFromSeason(int(season.AnidbSeason), string.split("-")[0])), tvdb=tvdbParse, status=status)
-                            Log("Common - MapSeries() - Season - AniDB: '%s', TvDB: '%s'" % (anidb.ParseNoFromSeason(int(season.AnidbSeason), string.split("-")[0]), tvdbParse))
+                for anidbEpisode, tvdbEpisodes in season.Episodes:
+                    anidbParse = anidb.ParseNoFromSeason(season.AnidbSeasonNo, anidbEpisode)
+                    for tvdbEpisode in tvdbEpisodes:
+                        status = "scudlee missing"
+                        tvdbParse = tvdb.ParseNoFromSeason(0, 0, ScudLee.DefaultTvdbSeason)
+                        tvdbKey = "S%sE%s" % (season.TvdbSeason, str(tvdbEpisode).zfill(2))
+                        if not mapping.xpath("""./Series/Episode[@tvdb="%s"]""" % (tvdbKey)) and tvdbKey != "S00E00":
+                            status = ""
+                            tvdbParse = tvdb.ParseNoFromSeason(season.TvdbSeasonNo, tvdbEpisode, ScudLee.DefaultTvdbSeason)
+                        elif not mapping.xpath("""./Series/Episode[@tvdb="%s"]""" % (tvdbKey)):
+                            status = "tvdb missing"
+                        SubElement(seriesMap, "Episode", anidb="%s" % (anidbParse), tvdb=tvdbParse, status=status)
+                        Log("Common - MapSeries() - Season - AniDB: '%s', TvDB: '%s'" % (anidbParse, tvdbParse))
                             
             if not ScudLee.Absolute: 
                 for i in range(1, AniDB.EpisodeCount+1):
@@ -4,9 +4,50 @@ from string import maketrans
 BaseDirectory = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))), "..", "..", "..", "..", "Plug-in Support", "Data", "com.plexapp.agents.amsa", "DataItems"))
 CacheDirectory = "Cache"
 CachePath = os.path.join(BaseDirectory, CacheDirectory)
+CacheIndexFile = "cache-index.json"
+CacheIndexSlack = 1000
+CacheImportMarker = "Cache/.imported"
+CacheManagerInterval = 300
+CacheManagerBatch = 500
+CacheEvictTarget = 0.9
+CacheSizeLimitDefault = 10240
+try: CacheSizeLimit = int(str(Prefs["CacheSizeLimit"]).strip()) * 1024 * 1024
+except (TypeError, ValueError): CacheSizeLimit = CacheSizeLimitDefault * 1024 * 1024
+CompressCache = Prefs["CompressCache"]
+CacheCompressedSuffix = ".gz"
+CacheCompressLevel = 6
+TitleColumnsFile = os.path.join(CacheDirectory, "anime-titles-columns.json")
+TitleSnapshotFile = os.path.join(CacheDirectory, "anime-titles.idx")
+TitleSnapshotMagic = "AMSATIDX"
+TitleSnapshotVersion = 1
+JsonStoreFlushDelay = 60
+SearchCacheFile = os.path.join(CacheDirectory, "search-cache.json")
+SearchCacheTime = CACHE_1HOUR * 24
+StartDateFile = os.path.join(CacheDirectory, "start-dates.json")
+SearchVerifyLimit = 4
+ReferenceCache = CACHE_1HOUR * 24 * 2
+RefreshInterval = CACHE_1HOUR
+MappingArtifactFile = os.path.join(CacheDirectory, "anime-list-index.json")
+MappingArtifactVersion = 1
+LockTimeout = 300
+LockWait = 5
+CustomCheckInterval = 60
+SearchTitleTypes = ["main", "official", "syn", "short"]
+XmlLang = "{http://www.w3.org/XML/1998/namespace}lang"
+FuzzyCutoff = 0.6
 BundleExportDirectory = "Export"
 BundleExportPath = os.path.join(BaseDirectory, BundleExportDirectory)
 DefaultTimeout = 30
+PoolMaxSize = 4
+PoolIdleTimeout = 60
+PoolMaxRedirects = 5
+NegativeCacheTime = 300
+BreakerThreshold = 3
+BreakerBackoff = 60
+BanBackoff = CACHE_1HOUR * 2
+BreakerMaxBackoff = CACHE_1HOUR * 24
+DownloadWorkers = 8
+DownloadHostLimit = 4
 DefaultCache = CACHE_1HOUR * 24 * 2
 ReplaceChars = maketrans("`", "'")
 StreamTypes = {1: "video", 2: "audio", 3: "subtitle"}
@@ -74,6 +115,7 @@ MINIMUM_WEIGHT                              = Prefs["MinimumWeight"]
 SERIES_TYPE_PRIORITY                        = ["main", "official", "syn", "synonym", "short"]
 ANIDB_THROTTLE_THRESHOLD                    = 100
 ANIDB_ANTIBAN_WAIT                          = int(Prefs["AniDbAntiBanDelay"]) if int(Prefs["AniDbAntiBanDelay"]) > 2 else 2
+ANIDB_ANTIBAN_BURST                         = 1
 ANIDB_BADTITLES                             = ["^TV Special$", "^Part . of .$", "^Episode [S]?.$", "^Special [S]?.$", "Complete Movie"]
 
 SEARCH_USE_ANIDB                             = Prefs["UseAniDBForAdvancedSearch"]
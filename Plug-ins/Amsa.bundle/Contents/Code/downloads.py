@@ -0,0 +1,73 @@
+import constants
+
+import Queue, threading, urlparse
+
+global pPipeline
+pPipeline = None
+
+def Pipeline():
+    global pPipeline
+    if pPipeline == None:
+        pPipeline = DownloadPipeline(constants.DownloadWorkers, constants.DownloadHostLimit)
+    return pPipeline
+
+def Fetch(jobs, loader, cache=constants.DefaultCache):
+    return Pipeline().Fetch(jobs, loader, cache)
+
+class DownloadPipeline():
+    def __init__(self, workers, hostLimit):
+        self.Queue = Queue.Queue()
+        self.Lock = threading.Lock()
+        self.Pending = {}
+        self.Hosts = {}
+        self.HostLimit = hostLimit
+        for i in range(0, workers):
+            worker = threading.Thread(target=self.Work, name="AmsaDownload-%s" % (i))
+            worker.daemon = True
+            worker.start()
+
+    def Fetch(self, jobs, loader, cache=constants.DefaultCache):
+        waiting = []
+        with self.Lock:
+            for url, localPath in jobs:
+                job = self.Pending.get(url)
+                if job == None:
+                    job = self.Pending[url] = self.Job(url, localPath, loader, cache)
+                    self.Queue.put(job)
+                waiting.append(job)
+        Log.Debug("Downloads - Fetch() - Jobs: '%s', Unique: '%s', Queued: '%s'" % (len(jobs), len(set(job.Url for job in waiting)), self.Queue.qsize()))
+        results = {}
+        for job in waiting:
+            job.Done.wait()
+            results[job.Url] = job.LocalPath if job.Result else None
+        return results
+
+    def HostLock(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self.Lock:
+            if not host in self.Hosts:
+                self.Hosts[host] = threading.BoundedSemaphore(self.HostLimit)
+            return self.Hosts[host]
+
+    def Work(self):
+        while True:
+            job = self.Queue.get()
+            try:
+                with self.HostLock(job.Url):
+                    job.Result = job.Loader(job.Url, os.path.basename(job.LocalPath), os.path.dirname(job.LocalPath), job.Cache) != None
+            except Exception as e:
+                Log.Debug("Downloads - Work() - url: '%s', Exception: '%s'" % (job.Url, e))
+            finally:
+                with self.Lock:
+                    self.Pending.pop(job.Url, None)
+                job.Done.set()
+                self.Queue.task_done()
+
+    class Job():
+        def __init__(self, url, localPath, loader, cache):
+            self.Url = url
+            self.LocalPath = localPath
+            self.Loader = loader
+            self.Cache = cache
+            self.Result = False
+            self.Done = threading.Event()
@@ -1,12 +1,9 @@
-import constants
+import constants, downloads, network, storage
 
 from lxml import etree
 from unidecode import unidecode
-from time import sleep
-from datetime import timedelta, datetime as dt
-
-global AniDB_WaitUntil
-AniDB_WaitUntil = dt.now() 
+from datetime import datetime as dt
+from array import array
 
 ns = etree.FunctionNamespace(None)
 ns['upper-case'] = lambda context, s: str.upper(s)
@@ -15,88 +12,144 @@ ns['clean-title'] = lambda context, s: CleanTitle(s)
 ns['clean-title-filter'] = lambda context, s: CleanTitle(s, True)
 ns['is-match'] = lambda context, x,y: SequenceMatch(x, y)
     
+global pStartDates
+pStartDates = None
+
+def StartDates():
+    global pStartDates
+    if pStartDates == None:
+        pStartDates = storage.JsonStore(constants.StartDateFile)
+    return pStartDates
+
+def GetStartDate(source, id):
+    return StartDates().Get("%s-%s" % (source, id))
+
+def SetStartDate(source, id, **values):
+    StartDates().Set("%s-%s" % (source, id), values)
+
 def XMLFromURL (url, filename="", directory="", cache=constants.DefaultCache, timeout=constants.DefaultTimeout):
-    global AniDB_WaitUntil  
-    result = LoadFile(filename, directory, cache) 
+    return network.Flight().Do(("XML", url, filename, directory), LoadXML, url, filename, directory, cache, timeout)
+
+def LoadXML (url, filename="", directory="", cache=constants.DefaultCache, timeout=constants.DefaultTimeout):
+    result = ParseFile(filename, directory, cache) 
     
-    if not result or (result and not len(result) > 1024):
-        Log.Debug("Functions - XMLFromURL() - url: '%s', filename: '%s'" % (url, filename))
+    if result is None:
+        Log.Debug("Functions - LoadXML() - url: '%s', filename: '%s'" % (url, filename))
+        complete = False
         try: 
-            if url.startswith(constants.ANIDB_HTTP_API_URL) or url.startswith(constants.ANIDB_TITLES) or url.startswith(constants.ANIDB_PIC_BASE_URL):
-                runOnce = True
-                while AniDB_WaitUntil > dt.now():
-                    if runOnce:
-                        Log("Functions - XMLFromURL() - AniDB AntiBan Delay: %s" % (AniDB_WaitUntil))
-                        runOnce = False
-                    sleep(0.1)
-                AniDB_WaitUntil = dt.now() + timedelta(seconds=constants.ANIDB_ANTIBAN_WAIT) 
+            if not network.Breaker().Allow(url):
+                Log.Debug("Functions - LoadXML() - Skipping url in backoff: '%s'" % (url))
+            else:
+                if url.startswith(constants.ANIDB_HTTP_API_URL) or url.startswith(constants.ANIDB_TITLES) or url.startswith(constants.ANIDB_PIC_BASE_URL):
+                    network.AniDBLimiter().Acquire()
 
-            result = GetFromUrl(url, timeout)
-            
-            if str(result).startswith("<error>") or str(result).startswith("<Element error at "):
-                Log.Debug("Functions - XMLFromURL() - Not an XML file, Possibly Ban, result: '%s'" % result)
-                result = None
+                result, complete = StreamXML(url, filename, directory, cache, timeout, GetValidators(filename, directory))
+                
+                if result is not None and result.tag == "error":
+                    Log.Debug("Functions - LoadXML() - Not an XML file, Possibly Ban, result: '%s'" % etree.tostring(result))
+                    # Only a ban counts against the host, any other error body just backs off this url
+                    banned = "banned" in (result.text or "").lower()
+                    network.Breaker().Failure(url, banned, banned)
+                    result = None
+                else:
+                    network.Breaker().Success(url)
                
         except Exception as e: 
             result = None 
-            Log.Debug("Functions - XMLFromURL() - XML issue loading url: '%s', Exception: '%s'" % (url, e))                                                    
+            network.Breaker().Failure(url, network.IsHostFailure(e))
+            Log.Debug("Functions - LoadXML() - XML issue loading url: '%s', Exception: '%s'" % (url, e))                                                    
     
-        if result and len(result) > 1024 and filename: 
-            try: SaveFile(result, os.path.basename(filename), directory)
-            except Exception as e: Log.Debug("Functions - XMLFromURL() - url: '%s', filename: '%s' saving failed: %s" % (url, filename, e))
-        elif filename and Data.Exists(filename):  # Loading locally if backup exists
-            Log.Debug("Functions - XMLFromURL() - Loading locally since banned or empty file (result page <1024 bytes)")
-            try: result = Data.Load(filename)
-            except Exception as e: Log.Debug("Functions - XMLFromURL() - Loading locally failed but data present - url: '%s', filename: '%s'" % (url, filename))
+        if not complete and filename:  # Loading locally if backup exists
+            Log.Debug("Functions - LoadXML() - Loading locally since banned or empty file (result page <1024 bytes)")
+            local = ParseFile(filename, directory, None)
+            if local is not None: result = local
     
-    if url==constants.ANIDB_TVDB_MAPPING and Data.Exists(constants.ANIDB_TVDB_MAPPING_CUSTOM):
-        if Data.Exists(constants.ANIDB_TVDB_MAPPING_CORRECTIONS):
-            Log.Debug("Functions - XMLFromURL() - Loading remote custom mapping - url: '%s'" % constants.ANIDB_TVDB_MAPPING_CORRECTIONS)
-            result_remote_custom = Data.Load(constants.ANIDB_TVDB_MAPPING_CORRECTIONS)     
-            result = result_remote_custom[:result_remote_custom.rfind("</anime-list>")-1] + result[result.find("<anime-list>")+len("<anime-list>")+1:]      
-        Log.Debug("Functions - XMLFromURL() - Loading local custom mapping - url: '%s'" % constants.ANIDB_TVDB_MAPPING_CUSTOM)
-        result_custom = Data.Load(constants.ANIDB_TVDB_MAPPING_CUSTOM)
-        result = result_custom[:result_custom.rfind("</anime-list>")-1] + result[result.find("<anime-list>")+len("<anime-list>")+1:] 
-
-    if result:
-        result = etree.fromstring(result) 
-        return result  
-        
-    return None
+    return result
     
-def GetFromUrl(url, timeout=constants.DefaultTimeout):
-    request = urllib2.Request(url, headers=constants.Default_headers)
-    request.add_header('Accept-encoding', 'gzip')
-    response = urllib2.urlopen(request, context=ssl.SSLContext(ssl.PROTOCOL_SSLv23), timeout=timeout)
-    if response.info().get('Content-Encoding') == 'gzip':
-        buf = StringIO.StringIO(response.read())
-        f = gzip.GzipFile(fileobj=buf)
-        return f.read()
-    else:
-        return response.read()
+def StreamXML(url, filename="", directory="", cache=constants.DefaultCache, timeout=constants.DefaultTimeout, headers=None):
+    response = network.Open(url, headers, timeout)
+    try:
+        if response.Status == 304:
+            response.Read()
+            result = ParseFile(filename, directory, None)
+            if result is not None:
+                Log.Debug("Functions - StreamXML() - Not modified, keeping cached copy - url: '%s'" % (url))
+                key = storage.Index().Lookup(os.path.join(constants.CacheDirectory, directory, filename))["key"]
+                storage.Index().Set(key, fetched=time.time(), ttl=cache)
+                # The scanner only sees the file, so its mtime has to say when the copy was last confirmed too
+                try: os.utime(storage.AbsolutePath(key), None)
+                except OSError: pass
+                return result, True
+        else:
+            # Decompress, parse and cache in one pass rather than holding the whole body as a string
+            writer = storage.CacheWriter(os.path.join(constants.CacheDirectory, directory, os.path.basename(filename)), constants.CompressCache) if filename else None
+            parser = etree.XMLParser()
+            size = 0
+            try:
+                for chunk in response.Stream():
+                    parser.feed(chunk)
+                    if writer: writer.Write(chunk)
+                    size = size + len(chunk)
+                result = parser.close()
+            except:
+                if writer: writer.Abort()
+                raise
+            complete = size > 1024 and result.tag != "error"
+            if writer and complete:
+                try: writer.Commit(url=url, ttl=cache, etag=response.Headers.get("etag"), modified=response.Headers.get("last-modified"))
+                except Exception as e: Log.Debug("Functions - StreamXML() - url: '%s', filename: '%s' saving failed: %s" % (url, filename, e))
+            elif writer:
+                writer.Abort()
+            return result, complete
+    finally: 
+        response.Close()
+    return StreamXML(url, filename, directory, cache, timeout)
+    
+def GetFromUrl(url, timeout=constants.DefaultTimeout, headers=None):
+    return GetResponse(url, timeout, headers)[2]
+
+def GetResponse(url, timeout=constants.DefaultTimeout, headers=None):
+    response = network.Open(url, headers, timeout)
+    try: return response.Status, response.Headers, response.Read()
+    finally: response.Close()
+
+def GetValidators(filename="", directory=""):
+    headers = {}
+    entry = storage.Index().Lookup(os.path.join(str(constants.CacheDirectory), str(directory), str(filename))) if filename else None
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("modified"):
+        headers["If-Modified-Since"] = entry["modified"]
+    return headers
         
 def FileFromURL (url, filename="", directory="", cache=constants.DefaultCache, timeout=constants.DefaultTimeout):
-    global AniDB_WaitUntil
+    return network.Flight().Do(("File", url, filename, directory), LoadFileFromURL, url, filename, directory, cache, timeout)
+
+def LoadFileFromURL (url, filename="", directory="", cache=constants.DefaultCache, timeout=constants.DefaultTimeout):
     result = LoadFile(filename, directory, cache) 
     if not result:
-        Log.Debug("Functions - FileFromURL() - url: '%s', filename: '%s'" % (url, filename))
+        Log.Debug("Functions - LoadFileFromURL() - url: '%s', filename: '%s'" % (url, filename))
         try: 
-            result = GetFromUrl(url, timeout)
+            if network.Breaker().Allow(url):
+                result = GetFromUrl(url, timeout)
+                network.Breaker().Success(url)
+            else:
+                Log.Debug("Functions - LoadFileFromURL() - Skipping url in backoff: '%s'" % (url))
         except Ex.HTTPError, e:
             result = None 
-            Log('Functions - FileFromURL() - HTTPError %s: %s' % (e.code, e.message))
+            network.Breaker().Failure(url, network.IsHostFailure(e))
+            Log('Functions - LoadFileFromURL() - HTTPError %s: %s' % (e.code, e.message))
             #if (e.code == 401):      
         except Exception as e: 
             result = None 
-            Log("Functions - FileFromURL() - Issue loading url: '%s', Exception: '%s'" % (url, e))                                                    
+            network.Breaker().Failure(url, network.IsHostFailure(e))
+            Log("Functions - LoadFileFromURL() - Issue loading url: '%s', Exception: '%s'" % (url, e))                                                    
         if result and filename: 
-            try: SaveFile(result, os.path.basename(filename), directory)
-            except Exception as e: Log.Debug("Functions - FileFromURL() - url: '%s', filename: '%s' saving failed: %s" % (url, filename, e))
-        elif filename and Data.Exists(filename):  # Loading locally if backup exists
-            Log.Debug("Functions - FileFromURL() - Loading locally since banned or empty file (result page <1024 bytes)")
-            try: result = Data.Load(filename)
-            except:
-                Log.Debug("Functions - FileFromURL() - Loading locally failed but data present - url: '%s', filename: '%s'" % (url, filename))
+            try: SaveFile(result, os.path.basename(filename), directory, url=url, cache=cache)
+            except Exception as e: Log.Debug("Functions - LoadFileFromURL() - url: '%s', filename: '%s' saving failed: %s" % (url, filename, e))
+        elif filename:  # Loading locally if backup exists
+            Log.Debug("Functions - LoadFileFromURL() - Loading locally since banned or empty file (result page <1024 bytes)")
+            result = LoadFile(filename, directory, None)
     if result:     
         return result  
     return None
@@ -104,41 +157,43 @@ def FileFromURL (url, filename="", directory="", cache=constants.DefaultCache, t
 def LoadFile(filename="", directory="", cache=constants.DefaultCache):  
     filename = os.path.join(str(constants.CacheDirectory), str(directory), str(filename)) 
     result = None
-    if filename and Data.Exists(filename):       
-        file = os.path.abspath(os.path.join(constants.CachePath, "..", filename))
-        if os.path.isfile(file) and os.stat(file).st_mtime > (time.time() - cache):
-            Log.Debug("Functions - LoadFile() - Filename: '%s', CacheTime: '%s', Limit: '%s'" % (file, time.ctime(os.stat(file).st_mtime), time.ctime(time.time() - cache)))
-            result = Data.Load(filename) 
+    entry = storage.Index().Lookup(filename)
+    if entry and (cache == None or entry["fetched"] > (time.time() - cache)):
+        Log.Debug("Functions - LoadFile() - Filename: '%s', CacheTime: '%s', Limit: '%s'" % (entry["key"], time.ctime(entry["fetched"]), time.ctime(time.time() - cache) if cache != None else "None"))
+        try: 
+            if entry["key"].endswith(constants.CacheCompressedSuffix):
+                with storage.Open(entry) as file: result = file.read()
+            else:
+                result = Data.Load(entry["key"]) 
+            storage.Index().Touch(entry["key"])
+        except Exception as e: 
+            Log.Debug("Functions - LoadFile() - Filename: '%s' indexed but unreadable: '%s'" % (entry["key"], e))
+            storage.Index().Remove(entry["key"])
     return result                
 
-def SaveFile(file, filename="", directory="", export=False):   
+def ParseFile(filename="", directory="", cache=constants.DefaultCache):  
+    filename = os.path.join(str(constants.CacheDirectory), str(directory), str(filename)) 
+    result = None
+    entry = storage.Index().Lookup(filename)
+    if entry and (cache == None or entry["fetched"] > (time.time() - cache)):
+        Log.Debug("Functions - ParseFile() - Filename: '%s', CacheTime: '%s'" % (entry["key"], time.ctime(entry["fetched"])))
+        try: 
+            with storage.Open(entry) as file: result = etree.parse(file).getroot()
+            storage.Index().Touch(entry["key"])
+        except Exception as e: 
+            Log.Debug("Functions - ParseFile() - Filename: '%s' indexed but unreadable: '%s'" % (entry["key"], e))
+            storage.Index().Remove(entry["key"])
+    return result                
+
+def SaveFile(file, filename="", directory="", export=False, url=None, cache=None, etag=None, modified=None):   
     absoDirectory = os.path.join(constants.CachePath if export == False else constants.BundleExportPath, directory)
     directory = os.path.join(constants.CacheDirectory if export == False else constants.BundleExportDirectory, directory)
     filename = os.path.join(directory, filename) 
-    if not os.path.exists(absoDirectory):
-        Log.Debug("Functions - SaveFile() - dir: '%s'" % (absoDirectory))
-        os.makedirs(absoDirectory)
+    storage.Index().EnsureDirectory(absoDirectory)
     Data.Save(filename, file)
+    if export == False:
+        storage.Index().Set(filename, url=url, fetched=time.time(), size=len(file), ttl=cache, etag=etag, modified=modified)
     
-def GetAnimeTitleByID(Tree, Id):    
-    return Tree.xpath("""/animetitles/anime[@aid="%s"]/*""" % Id)
-    
-def GetAnimeTitleByName(Tree, Name): 
-    Name = Name.lower()
-     
-    result = [] 
-    
-    result = Tree.xpath(u"""./anime/title
-                [@type='main' or @type='official' or @type='syn' or @type='short']
-                [lower-case(string(clean-title(string(text()))))="%s"
-                or contains(lower-case(string(clean-title(string(text())))), "%s")]""" % (Name, Name))
-    
-    if not result:
-        result = Tree.xpath(u"""./anime/title
-                [@type='main' or @type='official' or @type='syn' or @type='short']
-                [is-match("%s", lower-case(string(clean-title(string(text())))))]""" % (Name))           
-    return result
-
 def SequenceMatch(word, matcher, cutoff=0.6):
     result = False
     s = difflib.SequenceMatcher()
@@ -246,31 +301,23 @@ def PopulateMetadata(map, metaType, priorityList, metaList=None, secondType=None
                 return metaList
             if metaType is Framework.modelling.attributes.ProxyContainerObject:
                 if secondType == "Images":
-                    @parallelize
-                    def Image_Par():
-                        for image in sorted(data, key=lambda x: int(x.get("id")),  reverse=False):
-                            @task
-                            def Image_Task(image=image, metaList=metaList):
-                                #Log("Poster 1: %s, %s, %s" % (image.get("id"), image.get("mainLocalPath"), image.getparent().tag.lower()))
-                                if len(image.get("thumbUrl")) > 0:
-                                    FileFromURL(image.get("thumbUrl"), os.path.basename(image.get("thumbLocalPath")), os.path.dirname(image.get("thumbLocalPath")), CACHE_1HOUR * 24 * 2)
-                                else:
-                                    FileFromURL(image.get("mainUrl"), os.path.basename(image.get("mainLocalPath")), os.path.dirname(image.get("mainLocalPath")), CACHE_1HOUR * 24 * 2)
-                                #FileFromURL(image.get("mainUrl"), os.path.basename(image.get("mainLocalPath")), os.path.dirname(image.get("mainLocalPath")), CACHE_1HOUR * 24 * 2)
-                                if image.getparent().getparent().tag == "Season":
-                                    metaList[image.get("season")].posters[image.get("mainUrl")] = Proxy.Preview(Data.Load(image.get("thumbLocalPath")), sort_order=int(image.get("id"))) if len(image.get("thumbLocalPath")) > 0 else Proxy.Media(Data.Load(image.get("mainLocalPath")), sort_order=int(image.get("id")))
-                                    #metaList[image.get("season")].posters[image.get("mainUrl")] = Proxy.Media(Data.Load(image.get("mainLocalPath")), sort_order=int(image.get("id")))
-                                else:
-                                    metaList[image.get("mainUrl")] = Proxy.Preview(Data.Load(image.get("thumbLocalPath")), sort_order=int(image.get("id"))) if len(image.get("thumbLocalPath")) > 0 else Proxy.Media(Data.Load(image.get("mainLocalPath")), sort_order=int(image.get("id")))
-                                    #metaList[image.get("mainUrl")] = Proxy.Media(Data.Load(image.get("mainLocalPath")), sort_order=int(image.get("id")))
+                    images = sorted(data, key=lambda x: int(x.get("id")),  reverse=False)
+                    jobs = [(image.get("thumbUrl"), image.get("thumbLocalPath")) if len(image.get("thumbUrl")) > 0 else (image.get("mainUrl"), image.get("mainLocalPath")) for image in images]
+                    fetched = downloads.Fetch(jobs, FileFromURL, CACHE_1HOUR * 24 * 2)
+                    for image, (url, localPath) in zip(images, jobs):
+                        #Log("Poster 1: %s, %s, %s" % (image.get("id"), image.get("mainLocalPath"), image.getparent().tag.lower()))
+                        if not fetched.get(url): continue
+                        proxy = Proxy.Preview(Data.Load(localPath), sort_order=int(image.get("id"))) if len(image.get("thumbLocalPath")) > 0 else Proxy.Media(Data.Load(localPath), sort_order=int(image.get("id")))
+                        if image.getparent().getparent().tag == "Season":
+                            metaList[image.get("season")].posters[image.get("mainUrl")] = proxy
+                        else:
+                            metaList[image.get("mainUrl")] = proxy
                 elif secondType == "Themes":
-                    @parallelize
-                    def Theme_Par():
-                        for theme in sorted(data, key=lambda x: x.get("id"), reverse=False):
-                            @task
-                            def Theme_Task(theme=theme, metaList=metaList):
-                                FileFromURL(theme.get("url"), os.path.basename(theme.get("localPath")), os.path.dirname(theme.get("localPath")), CACHE_1HOUR * 24 * 2)
-                                metaList[theme.get("url")] = Proxy.Media(Data.Load(theme.get("localPath")), sort_order=theme.get("id"))
+                    themes = sorted(data, key=lambda x: x.get("id"), reverse=False)
+                    fetched = downloads.Fetch([(theme.get("url"), theme.get("localPath")) for theme in themes], FileFromURL, CACHE_1HOUR * 24 * 2)
+                    for theme in themes:
+                        if fetched.get(theme.get("url")):
+                            metaList[theme.get("url")] = Proxy.Media(Data.Load(theme.get("localPath")), sort_order=theme.get("id"))
                 return metaList
             else:
                 return (metaType)(data)   
@@ -300,6 +347,24 @@ def lev_ratio(s1, s2):
         pass
 
     return ratio  
+
+def lev_ratios(s1, targets):
+    # Same ratios as lev_ratio, scoring every target against s1 with two reused rows and once per distinct target
+    word = safe_unicode(s1)
+    previous = array("i", range(len(word) + 1))
+    current = array("i", previous)
+    ratios = {}
+    for s2 in targets:
+        if s2 in ratios: continue
+        for j in range(len(word) + 1): previous[j] = j
+        for i, char in enumerate(safe_unicode(s2)):
+            current[0] = i + 1
+            for j in range(len(word)):
+                current[j + 1] = min(previous[j + 1] + 1, current[j] + 1, previous[j] + (word[j] != char))
+            previous, current = current, previous
+        max_len = float(max([ len(s1), len(s2) ]))
+        ratios[s2] = float(1 - (previous[len(word)]/max_len)) if max_len else 0.0
+    return ratios
     
 def safe_unicode(s, encoding='utf-8'):
     if s is None:
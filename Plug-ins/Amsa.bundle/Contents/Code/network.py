@@ -0,0 +1,284 @@
+import constants
+
+import datetime, httplib, socket, ssl, threading, urlparse, urllib2, zlib
+from time import time, sleep
+
+global pPool, pAniDBLimiter, pFlight, pBreaker
+pPool = None
+pAniDBLimiter = None
+pFlight = None
+pBreaker = None
+
+def Pool():
+    global pPool
+    if pPool == None:
+        pPool = ConnectionPool(constants.PoolMaxSize, constants.PoolIdleTimeout)
+    return pPool
+
+def AniDBLimiter():
+    global pAniDBLimiter
+    if pAniDBLimiter == None:
+        pAniDBLimiter = RateLimiter("AniDB", 1.0 / constants.ANIDB_ANTIBAN_WAIT, constants.ANIDB_ANTIBAN_BURST)
+    return pAniDBLimiter
+
+def Flight():
+    global pFlight
+    if pFlight == None:
+        pFlight = SingleFlight()
+    return pFlight
+
+def Breaker():
+    global pBreaker
+    if pBreaker == None:
+        pBreaker = CircuitBreaker()
+    return pBreaker
+
+def IsHostFailure(error):
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code == 429
+    return True
+
+def Open(url, headers=None, timeout=constants.DefaultTimeout):
+    return Pool().Open(url, headers, timeout)
+
+class ConnectionPool():
+    def __init__(self, maxSize, idleTimeout):
+        self.MaxSize = maxSize
+        self.IdleTimeout = idleTimeout
+        self.Context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.Lock = threading.Lock()
+        self.Idle = {}
+
+    def Acquire(self, key, timeout):
+        connection = None
+        with self.Lock:
+            idle = self.Idle.get(key, [])
+            while idle and not connection:
+                candidate, released = idle.pop()
+                if released > time() - self.IdleTimeout:
+                    connection = candidate
+                else:
+                    candidate.close()
+        if connection:
+            if connection.sock: connection.sock.settimeout(timeout)
+            return connection, True
+        return self.Connect(key, timeout), False
+
+    def Connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=timeout, context=self.Context)
+        return httplib.HTTPConnection(host, port, timeout=timeout)
+
+    def Release(self, key, connection):
+        with self.Lock:
+            idle = self.Idle.setdefault(key, [])
+            if len(idle) < self.MaxSize:
+                idle.append((connection, time()))
+                connection = None
+        if connection: connection.close()
+        self.Purge()
+
+    def Purge(self):
+        with self.Lock:
+            for key in self.Idle.keys():
+                for connection, released in [item for item in self.Idle[key] if item[1] <= time() - self.IdleTimeout]:
+                    self.Idle[key].remove((connection, released))
+                    connection.close()
+                if not self.Idle[key]:
+                    del self.Idle[key]
+
+    def Open(self, url, headers=None, timeout=constants.DefaultTimeout):
+        for redirect in range(0, constants.PoolMaxRedirects + 1):
+            parsed = urlparse.urlsplit(url)
+            key = (parsed.scheme, parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80))
+            path = parsed.path or "/"
+            if parsed.query: path = path + "?" + parsed.query
+
+            requestHeaders = dict(constants.Default_headers)
+            requestHeaders["Accept-Encoding"] = "gzip"
+            requestHeaders["Host"] = parsed.netloc
+            if headers: requestHeaders.update(headers)
+
+            connection, reused = self.Acquire(key, timeout)
+            try:
+                connection.request("GET", path, headers=requestHeaders)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if not reused: raise
+                Log.Debug("Network - Open() - Stale connection to '%s', reconnecting: '%s'" % (parsed.netloc, e))
+                connection = self.Connect(key, timeout)
+                connection.request("GET", path, headers=requestHeaders)
+                response = connection.getresponse()
+
+            result = Response(self, key, connection, response, url)
+            if result.Status in (301, 302, 303, 307, 308) and result.Headers.get("location"):
+                result.Read()
+                result.Close()
+                url = urlparse.urljoin(url, result.Headers.get("location"))
+                continue
+            if result.Status >= 400:
+                result.Read()
+                result.Close()
+                raise urllib2.HTTPError(url, result.Status, response.reason, response.msg, None)
+            return result
+        raise urllib2.URLError("Too many redirects for '%s'" % (url))
+
+class Response():
+    def __init__(self, pool, key, connection, response, url):
+        self.Pool = pool
+        self.Key = key
+        self.Connection = connection
+        self.Raw = response
+        self.Url = url
+        self.Status = response.status
+        self.Headers = dict((name.lower(), value) for name, value in response.getheaders())
+        self.Complete = False
+
+    def Stream(self, size=64 * 1024):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if self.Headers.get("content-encoding") == "gzip" else None
+        while True:
+            chunk = self.Raw.read(size)
+            if not chunk: break
+            if decoder:
+                chunk = decoder.decompress(chunk)
+                if not chunk: continue
+            yield chunk
+        if decoder:
+            chunk = decoder.flush()
+            if chunk: yield chunk
+        self.Complete = True
+
+    def Read(self):
+        return "".join(self.Stream())
+
+    def Close(self):
+        if self.Connection == None: return
+        if self.Complete and not self.Raw.will_close:
+            self.Pool.Release(self.Key, self.Connection)
+        else:
+            self.Connection.close()
+        self.Connection = None
+
+class RateLimiter():
+    def __init__(self, name, rate, burst):
+        self.Name = name
+        self.Rate = rate
+        self.Burst = burst
+        self.Tokens = float(burst)
+        self.Updated = time()
+        self.Lock = threading.Lock()
+        self.Waiting = 0
+        self.LastWait = 0.0
+        self.TotalWait = 0.0
+
+    def Acquire(self):
+        # Tokens go negative to reserve future slots, so callers are served in the order they took the lock
+        with self.Lock:
+            now = time()
+            self.Tokens = min(float(self.Burst), self.Tokens + (now - self.Updated) * self.Rate) - 1
+            self.Updated = now
+            wait = -self.Tokens / self.Rate if self.Tokens < 0 else 0.0
+            self.LastWait = wait
+            self.TotalWait = self.TotalWait + wait
+            if wait > 0: self.Waiting = self.Waiting + 1
+        if wait > 0:
+            Log("Network - Acquire() - %s AntiBan Delay: %.2fs, Queue: %s" % (self.Name, wait, self.Waiting))
+            sleep(wait)
+            with self.Lock:
+                self.Waiting = self.Waiting - 1
+        return wait
+
+    def QueueDepth(self):
+        return self.Waiting
+
+class SingleFlight():
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.Calls = {}
+
+    def Do(self, key, function, *args, **kwargs):
+        with self.Lock:
+            call = self.Calls.get(key)
+            leader = call == None
+            if leader:
+                call = self.Calls[key] = self.Call()
+        if not leader:
+            Log.Debug("Network - Do() - Waiting on in-flight request: '%s'" % (str(key)))
+            call.Done.wait()
+            if call.Error: raise call.Error
+            return call.Result
+        try:
+            call.Result = function(*args, **kwargs)
+        except Exception as e:
+            call.Error = e
+            raise
+        finally:
+            with self.Lock:
+                del self.Calls[key]
+            call.Done.set()
+        return call.Result
+
+    class Call():
+        def __init__(self):
+            self.Done = threading.Event()
+            self.Result = None
+            self.Error = None
+
+class CircuitBreaker():
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.Urls = {}
+        self.Hosts = {}
+
+    def Allow(self, url):
+        now = time()
+        host = urlparse.urlsplit(url).netloc
+        with self.Lock:
+            failure = self.Urls.get(url)
+            if failure and failure.Until > now:
+                return False
+            circuit = self.Hosts.get(host)
+            if circuit and circuit.State == "open":
+                if circuit.Until > now:
+                    return False
+                Log.Debug("Network - Allow() - Host '%s' half-open, probing with '%s'" % (host, url))
+                circuit.State = "half-open"
+                return True
+            if circuit and circuit.State == "half-open":
+                return False
+        return True
+
+    def Success(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self.Lock:
+            self.Urls.pop(url, None)
+            if self.Hosts.pop(host, None):
+                Log.Debug("Network - Success() - Host '%s' recovered" % (host))
+
+    def Failure(self, url, hostFailure=True, banned=False):
+        now = time()
+        host = urlparse.urlsplit(url).netloc
+        with self.Lock:
+            failure = self.Urls.setdefault(url, self.Circuit())
+            failure.Count = failure.Count + 1
+            failure.Until = now + min(constants.NegativeCacheTime * 2 ** (failure.Count - 1), constants.BreakerMaxBackoff)
+            if not hostFailure:
+                self.Hosts.pop(host, None)
+                return
+            circuit = self.Hosts.setdefault(host, self.Circuit())
+            circuit.Count = circuit.Count + 1
+            if banned or circuit.State == "half-open" or circuit.Count >= constants.BreakerThreshold:
+                circuit.Opened = circuit.Opened + 1
+                backoff = constants.BanBackoff if banned else constants.BreakerBackoff
+                circuit.Until = now + min(backoff * 2 ** (circuit.Opened - 1), constants.BreakerMaxBackoff)
+                circuit.State = "open"
+                Log("Network - Failure() - Host '%s' %s, backing off until %s" % (host, "banned" if banned else "failing", datetime.datetime.fromtimestamp(circuit.Until)))
+
+    class Circuit():
+        def __init__(self):
+            self.State = "closed"
+            self.Count = 0
+            self.Opened = 0
+            self.Until = 0
@@ -1,36 +1,268 @@
-import constants, functions
+import constants, functions, network, storage, titles
 
 from functions import XMLFromURL, GetElementText
+from lxml import etree
+from array import array
+from time import time, sleep
+import datetime, json, threading
  
-global pTitleTree, pMappingTree, pCollectionTree, pCorrectionsTree
-pTitleTree = None
-pMappingTree = None
+global pTitleIndex, pMappingBase, pMappingIndex, pCustomChecked, pCollectionTree, pRefresher, pLoaded
+pTitleIndex = None
+pMappingBase = None
+pMappingIndex = None
+pCustomChecked = 0
 pCollectionTree = None
-pCorrectionsTree = None
+pRefresher = None
+pLoaded = {}
     
-def TitleTree():
-    global pTitleTree
-    if pTitleTree == None:
-        pTitleTree = XMLFromURL(constants.ANIDB_TITLES, os.path.splitext(os.path.basename(constants.ANIDB_TITLES))[0], "", CACHE_1HOUR * 24 * 2, 60)
-    return pTitleTree
+def TitleStore():
+    return TitleIndex().Store
+
+def TitleIndex():
+    # The burst of searches after a library scan shares one first load instead of each building its own
+    if pTitleIndex == None:
+        return network.Flight().Do(("Reference", "titles"), InitTitleIndex)
+    return pTitleIndex
+
+def InitTitleIndex():
+    global pTitleIndex
+    if pTitleIndex == None:
+        index = LoadTitleIndex()
+        if not len(index.Store): return index
+        pTitleIndex = index
+        pLoaded["titles"] = time()
+    return pTitleIndex
+
+def LoadTitleIndex():
+    return titles.Load(constants.ANIDB_TITLES, os.path.splitext(os.path.basename(constants.ANIDB_TITLES))[0], constants.ReferenceCache, 60)
     
 def MappingTree():
-    global pMappingTree
-    if pMappingTree == None:
-        pMappingTree = XMLFromURL(constants.ANIDB_TVDB_MAPPING, os.path.basename(constants.ANIDB_TVDB_MAPPING), "", CACHE_1HOUR * 24 * 2, 60)
-    return pMappingTree
+    return XMLFromURL(constants.ANIDB_TVDB_MAPPING, os.path.basename(constants.ANIDB_TVDB_MAPPING), "", constants.ReferenceCache, 60)
+
+def CorrectionsTree():
+    return XMLFromURL(constants.ANIDB_TVDB_MAPPING_CORRECTIONS, os.path.basename(constants.ANIDB_TVDB_MAPPING_CORRECTIONS), "", constants.ReferenceCache, 60)
+    
+def MappingBase():
+    if pMappingBase == None:
+        return network.Flight().Do(("Reference", "mapping"), InitMappingBase)
+    return pMappingBase
+
+def InitMappingBase():
+    global pMappingBase
+    if pMappingBase == None:
+        entries, complete = LoadMappingBase(constants.LockWait)
+        if not complete: return entries
+        pMappingBase = entries
+        pLoaded["mapping"] = time()
+    return pMappingBase
+
+def LoadMappingBase(wait):
+    # Corrections over master, read from the shared index artifact while both source files are fresh and unchanged
+    # A lock still held after wait seconds means another process is writing it, so parse the lists instead
+    sources = MappingSources()
+    version = MappingVersion(sources) if sources and min([source["fetched"] for source in sources]) > time() - constants.ReferenceCache else None
+    if version:
+        if storage.WaitForLock(constants.MappingArtifactFile, wait):
+            entries = LoadArtifact(version)
+            if entries != None: return entries, True
+        else: Log.Debug("Scudlee - LoadMappingBase() - Mapping index locked by another process, parsing the lists")
+    master, corrections = MappingTree(), CorrectionsTree()
+    if master is None: return MergeLayers([ToEntries(corrections)]), False
+    entries = MergeLayers([ToEntries(corrections), ToEntries(master)])
+    sources = MappingSources()
+    version = MappingVersion(sources) if sources and corrections is not None else None
+    if version: SaveArtifact(version, entries)
+    return entries, True
+
+def MappingSources():
+    sources = [storage.Index().Lookup(os.path.join(constants.CacheDirectory, os.path.basename(url))) for url in (constants.ANIDB_TVDB_MAPPING, constants.ANIDB_TVDB_MAPPING_CORRECTIONS)]
+    return sources if all(sources) else None
+
+def MappingVersion(sources):
+    hashes = [storage.SourceHash(source) for source in sources]
+    if not all(hashes): return None
+    return "%s-%s" % (constants.MappingArtifactVersion, "-".join(hashes))
+
+def LoadArtifact(version):
+    entry = storage.Index().Get(constants.MappingArtifactFile)
+    if not entry: return None
+    try:
+        with storage.Open(entry) as file: data = json.load(file)
+        if data.get("version") != version:
+            Log.Debug("Scudlee - LoadArtifact() - Mapping index is out of date, rebuilding")
+            return None
+        entries = [MappingEntry(attrib, [MappingItem(itemAttrib, text) for itemAttrib, text in items]) for attrib, items in data["entries"]]
+        Log.Debug("Scudlee - LoadArtifact() - Entries: '%s'" % (len(entries)))
+        return entries
+    except Exception as e:
+        Log.Debug("Scudlee - LoadArtifact() - '%s' unreadable: '%s'" % (entry["key"], e))
+        return None
+
+def SaveArtifact(version, entries):
+    if not storage.AcquireLock(constants.MappingArtifactFile):
+        Log.Debug("Scudlee - SaveArtifact() - Mapping index is being written by another process")
+        return
+    try:
+        writer = storage.CacheWriter(constants.MappingArtifactFile)
+        writer.Write(json.dumps({"version": version, "entries": [[entry.attrib, [[item.attrib, item.text] for item in entry.Items]] for entry in entries]}))
+        writer.Commit()
+        Log.Debug("Scudlee - SaveArtifact() - Version: '%s', Entries: '%s'" % (version, len(entries)))
+    except Exception as e:
+        Log.Debug("Scudlee - SaveArtifact() - Saving failed: '%s'" % (e))
+    finally:
+        storage.ReleaseLock(constants.MappingArtifactFile)
+
+def MappingIndex():
+    # The custom list is small and edited by hand, so only its change rebuilds the layers, master and corrections stay loaded
+    # Its mtime is checked at most once per CustomCheckInterval rather than on every lookup
+    # An index over an incomplete base (master missing) is rebuilt on the same interval until master loads
+    global pCustomChecked
+    if pMappingIndex == None or pCustomChecked < time() - constants.CustomCheckInterval:
+        pCustomChecked = time()
+        if pMappingIndex == None or pMappingBase == None or pMappingIndex.CustomModified != CustomModified():
+            return network.Flight().Do(("Reference", "mappingindex"), UpdateMappingIndex)
+    return pMappingIndex
+
+def UpdateMappingIndex():
+    global pMappingIndex
+    if pMappingIndex == None or pMappingBase == None or pMappingIndex.CustomModified != CustomModified():
+        pMappingIndex = LoadMappingIndex(MappingBase())
+    return pMappingIndex
+
+def CustomModified():
+    path = storage.AbsolutePath(storage.Key(constants.ANIDB_TVDB_MAPPING_CUSTOM))
+    return os.path.getmtime(path) if os.path.isfile(path) else None
+
+def LoadMappingIndex(base):
+    modified = CustomModified()
+    custom = None
+    if modified != None:
+        path = storage.AbsolutePath(storage.Key(constants.ANIDB_TVDB_MAPPING_CUSTOM))
+        try: 
+            custom = etree.parse(path).getroot()
+            Log.Debug("Scudlee - LoadMappingIndex() - Loading local custom mapping: '%s'" % (path))
+        except Exception as e: Log.Debug("Scudlee - LoadMappingIndex() - Custom mapping '%s' unreadable: '%s'" % (path, e))
+    index = Mappings(MergeLayers([ToEntries(custom), base]))
+    index.CustomModified = modified
+    return index
     
 def CollectionTree():
     global pCollectionTree
     if pCollectionTree == None:
-        pCollectionTree = XMLFromURL(constants.ANIDB_COLLECTION, os.path.basename(constants.ANIDB_COLLECTION), "", CACHE_1HOUR * 24 * 2, 60)
+        pCollectionTree = LoadCollectionTree()
+        if pCollectionTree is not None: pLoaded["collection"] = time()
     return pCollectionTree
 
-def CorrectionsTree():
-    global pCorrectionsTree
-    if pCorrectionsTree == None:
-        pCorrectionsTree = XMLFromURL(constants.ANIDB_TVDB_MAPPING_CORRECTIONS, os.path.basename(constants.ANIDB_TVDB_MAPPING_CORRECTIONS), "", CACHE_1HOUR * 24 * 2, 60)
-    return pCorrectionsTree
+def LoadCollectionTree():
+    return XMLFromURL(constants.ANIDB_COLLECTION, os.path.basename(constants.ANIDB_COLLECTION), "", constants.ReferenceCache, 60)
+
+def Refresher():
+    global pRefresher
+    if pRefresher == None:
+        pRefresher = ReferenceRefresher()
+    return pRefresher
+
+class ReferenceRefresher():
+    # Rebuilds expired reference data off the request path, requests keep the last good version until the swap
+    def __init__(self):
+        self.Thread = None
+
+    def Start(self):
+        if self.Thread != None: return
+        self.Thread = threading.Thread(target=self.Run, name="AmsaRefresher")
+        self.Thread.daemon = True
+        self.Thread.start()
+
+    def Run(self):
+        while True:
+            sleep(constants.RefreshInterval)
+            for name, refresh in (("titles", self.RefreshTitles), ("mapping", self.RefreshMapping), ("collection", self.RefreshCollection)):
+                if name in pLoaded and pLoaded[name] < time() - constants.ReferenceCache:
+                    Log.Debug("Scudlee - Run() - Refreshing '%s' loaded %s" % (name, datetime.datetime.fromtimestamp(pLoaded[name])))
+                    try: refresh()
+                    except Exception as e: Log.Debug("Scudlee - Run() - Refreshing '%s' failed, keeping the last version: '%s'" % (name, e))
+
+    def RefreshTitles(self):
+        global pTitleIndex
+        index = LoadTitleIndex()
+        if len(index.Store):
+            pTitleIndex = index
+            pLoaded["titles"] = time()
+
+    def RefreshMapping(self):
+        global pMappingBase, pMappingIndex
+        entries, complete = LoadMappingBase(constants.LockTimeout)
+        if complete:
+            index = LoadMappingIndex(entries)
+            pMappingBase, pMappingIndex = entries, index
+            pLoaded["mapping"] = time()
+
+    def RefreshCollection(self):
+        global pCollectionTree
+        tree = LoadCollectionTree()
+        if tree is not None:
+            pCollectionTree = tree
+            pLoaded["collection"] = time()
+
+def ToEntries(tree):
+    if tree is None: return []
+    return [MappingEntry(dict(anime.attrib), [MappingItem(dict(item.attrib), item.text) for item in anime.iterfind("mapping-list/mapping")]) for anime in tree.iterchildren("anime")]
+
+def MergeLayers(layers):
+    # Layers in priority order, an anidbid found in a layer hides its entries in every layer below
+    result = []
+    seen = set()
+    for layer in layers:
+        current = set()
+        for entry in layer:
+            if not entry.get("anidbid") in seen:
+                result.append(entry)
+                current.add(entry.get("anidbid"))
+        seen.update(current)
+    return result
+    
+class MappingEntry(object):
+    # Stands in for an anime-list <anime> element, attributes plus its mapping-list items
+    __slots__ = ("attrib", "Items", "MappingList")
+
+    def __init__(self, attrib, items):
+        self.attrib = attrib
+        self.Items = items
+        self.MappingList = None
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+class MappingItem(object):
+    __slots__ = ("attrib", "text")
+
+    def __init__(self, attrib, text):
+        self.attrib = attrib
+        self.text = text
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+class Mappings():
+    def __init__(self, entries):
+        self.CustomModified = None
+        self.Anidb = {}
+        self.Tvdb = {}
+        for entry in entries:
+            self.Anidb.setdefault(entry.get("anidbid"), []).append(entry)
+            self.Tvdb.setdefault(entry.get("tvdbid"), []).append(entry)
+            if entry.Items and entry.MappingList == None:
+                entry.MappingList = [ScudLee.Mapping(item) for item in entry.Items]
+        Log.Debug("Scudlee - Mappings() - Anidb: '%s', Tvdb: '%s'" % (len(self.Anidb), len(self.Tvdb)))
+
+    def MappingList(self, entry):
+        return entry.MappingList or []
+
+    def ByAnidb(self, anidbid):
+        return list(self.Anidb.get(str(anidbid), []))
+
+    def ByTvdb(self, tvdbid):
+        return list(self.Tvdb.get(str(tvdbid), []))
 
 class ScudLee():
     AnidbId = None
@@ -44,17 +276,17 @@ class ScudLee():
     def __init__(self, anidbid = None, tvdbid = None):
         if anidbid != None or tvdbid != None:
             if anidbid != None: 
-                data = MappingTree().xpath("""./anime[@anidbid="%s"]""" % (anidbid))
+                data = MappingIndex().ByAnidb(anidbid)
             elif tvdbid != None: 
-                data = MappingTree().xpath("""./anime[@tvdbid="%s"]""" % (tvdbid))
+                data = MappingIndex().ByTvdb(tvdbid)
 				
             if data != None:
                 self.Load(data[0])
                 self.SeriesList = []
                 if self.TvdbId:
-                    self.SeriesList = MappingTree().xpath("""./anime[@tvdbid="%s"]""" % (self.TvdbId))
+                    self.SeriesList = MappingIndex().ByTvdb(self.TvdbId)
                 else:
-                    self.SeriesList = MappingTree().xpath("""./anime[@anidbid="%s"]""" % (self.AnidbId))
+                    self.SeriesList = MappingIndex().ByAnidb(self.AnidbId)
                 visited = []
                 remove = []
 
@@ -94,10 +326,9 @@ class ScudLee():
             self.Absolute = True 
         if data.get("defaulttvdbseason") and not self.Absolute:
             self.DefaultTvdbSeason = int(data.get("defaulttvdbseason"))
-        if data.xpath("""./mapping-list/mapping"""):  
-            self.MappingList = []
-            for item in data.xpath("""./mapping-list/mapping"""):
-                self.MappingList.append(self.Mapping(item))
+        mappingList = MappingIndex().MappingList(data)
+        if mappingList:  
+            self.MappingList = mappingList
             
     class Mapping(): 
         Text = None
@@ -106,8 +337,12 @@ class ScudLee():
         End = None
         AnidbSeason = None
         TvdbSeason = None
+        OffsetNo = 0
+        AnidbSeasonNo = None
+        TvdbSeasonNo = None
         
         def __init__(self, data):
+            self.Episodes = []
             if data.text:
                 self.Text = data.text
             if data.get("offset"):
@@ -120,5 +355,12 @@ class ScudLee():
                 self.AnidbSeason = data.get("anidbseason").zfill(2)
             if data.get("tvdbseason"):
                 self.TvdbSeason = data.get("tvdbseason").zfill(2)
+            if self.Offset: self.OffsetNo = int(self.Offset)
+            if self.AnidbSeason: self.AnidbSeasonNo = int(self.AnidbSeason)
+            if self.TvdbSeason: self.TvdbSeasonNo = int(self.TvdbSeason)
+            # ";1-5;2-6+7;" becomes [(1, [5]), (2, [6, 7])], anidb episode to the tvdb episodes it covers
+            for pair in filter(None, (self.Text or "").split(";")):
+                try: self.Episodes.append((int(pair.split("-")[0]), array("i", [int(x) for x in pair.split("-")[1].split("+")])))
+                except (IndexError, ValueError): Log.Debug("Scudlee - Mapping() - Skipping malformed mapping: '%s'" % (pair))
         
         
\ No newline at end of file
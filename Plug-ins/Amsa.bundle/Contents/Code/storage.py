@@ -0,0 +1,338 @@
+import constants
+
+import gzip, hashlib, json, threading
+from time import time, sleep
+
+global pIndex, pManager, pStores
+pIndex = None
+pManager = None
+pStores = []
+
+def Index():
+    global pIndex
+    if pIndex == None:
+        pIndex = CacheIndex(os.path.join(constants.CachePath, constants.CacheIndexFile))
+    return pIndex
+
+def Manager():
+    global pManager
+    if pManager == None:
+        pManager = CacheManager(Index(), constants.CacheSizeLimit)
+    return pManager
+
+def Key(filename):
+    path = os.path.normpath(filename)
+    if os.path.isabs(path):
+        try: relative = os.path.relpath(path, constants.BaseDirectory)
+        except ValueError: relative = os.pardir
+        if not relative.startswith(os.pardir): path = relative
+    return path.replace("\\", "/")
+
+def AbsolutePath(key):
+    if os.path.isabs(key): return key
+    return os.path.join(constants.BaseDirectory, *key.split("/"))
+
+def Open(entry):
+    path = AbsolutePath(entry["key"])
+    if entry["key"].endswith(constants.CacheCompressedSuffix):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+def FileHash(entry):
+    digest = hashlib.md5()
+    with open(AbsolutePath(entry["key"]), "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def SourceHash(entry):
+    # None once the file behind an index entry is gone, the stale entry is dropped so the caller fetches it again
+    try: return FileHash(entry)
+    except (IOError, OSError) as e:
+        Log.Debug("Storage - SourceHash() - '%s' unreadable, removing it from the index: '%s'" % (entry["key"], e))
+        Index().Remove(entry["key"])
+        return None
+
+def AcquireLock(filename):
+    # O_EXCL lock file shared with other processes, one older than LockTimeout is taken to be left by a dead writer
+    path = AbsolutePath(Key(filename)) + ".lock"
+    for attempt in range(0, 2):
+        try:
+            handle = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(handle, str(os.getpid()))
+            os.close(handle)
+            return True
+        except OSError:
+            if not RemoveStaleLock(path): return False
+    return False
+
+def RemoveStaleLock(path):
+    try:
+        if os.path.getmtime(path) > time() - constants.LockTimeout: return False
+        Log.Debug("Storage - RemoveStaleLock() - Removing stale lock: '%s'" % (path))
+        os.remove(path)
+    except OSError: pass
+    return True
+
+def ReleaseLock(filename):
+    try: os.remove(AbsolutePath(Key(filename)) + ".lock")
+    except OSError: pass
+
+def WaitForLock(filename, timeout):
+    # True once the lock is gone, False if it is still held after timeout
+    path = AbsolutePath(Key(filename)) + ".lock"
+    if not os.path.exists(path) or RemoveStaleLock(path): return True
+    until = time() + timeout
+    while os.path.exists(path) and time() < until:
+        sleep(1)
+    return not os.path.exists(path)
+
+def ReplaceFile(source, destination):
+    if os.name == "nt" and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+class CacheWriter():
+    def __init__(self, filename, compress=False):
+        self.Plain = Key(filename)
+        self.Key = self.Plain + (constants.CacheCompressedSuffix if compress else "")
+        self.Path = AbsolutePath(self.Key)
+        Index().EnsureDirectory(os.path.dirname(self.Path))
+        self.Raw = open(self.Path + ".tmp", "wb")
+        self.File = gzip.GzipFile(os.path.basename(self.Plain), "wb", constants.CacheCompressLevel, self.Raw) if compress else self.Raw
+
+    def Write(self, data):
+        self.File.write(data)
+
+    def Commit(self, **values):
+        self.File.close()
+        self.Raw.close()
+        values.update(fetched=time(), size=os.path.getsize(self.Path + ".tmp"))
+        ReplaceFile(self.Path + ".tmp", self.Path)
+        # Drop the copy in the other format so toggling CompressCache never leaves a stale twin behind
+        other = self.Plain if self.Key != self.Plain else self.Plain + constants.CacheCompressedSuffix
+        if other in Index().Entries:
+            try: os.remove(AbsolutePath(other))
+            except OSError: pass
+            Index().Remove(other)
+        return Index().Set(self.Key, **values)
+
+    def Abort(self):
+        self.File.close()
+        self.Raw.close()
+        try: os.remove(self.Path + ".tmp")
+        except OSError: pass
+
+class JsonStore():
+    # Small persistent dict kept in memory, written back at most every JsonStoreFlushDelay or by the cache manager
+    def __init__(self, filename):
+        self.Filename = filename
+        self.Lock = threading.Lock()
+        self.Data = {}
+        self.Dirty = False
+        self.Saved = time()
+        self.Load()
+        pStores.append(self)
+
+    def Load(self):
+        entry = Index().Get(self.Filename)
+        if not entry: return
+        try:
+            with Open(entry) as file: self.Data = json.load(file)
+        except Exception as e:
+            Log.Debug("Storage - Load() - Store '%s' unreadable, starting empty: '%s'" % (entry["key"], e))
+            self.Data = {}
+
+    def Get(self, key):
+        entry = self.Data.get(key)
+        if entry == None or (entry["expires"] != None and entry["expires"] < time()): return None
+        return entry["value"]
+
+    def Set(self, key, value, ttl=None):
+        with self.Lock:
+            self.Data[key] = {"value": value, "expires": time() + ttl if ttl != None else None}
+            self.Dirty = True
+        if self.Saved < time() - constants.JsonStoreFlushDelay:
+            self.Flush()
+
+    def Flush(self):
+        with self.Lock:
+            if not self.Dirty: return
+            now = time()
+            for key in [key for key, entry in self.Data.iteritems() if entry["expires"] != None and entry["expires"] < now]:
+                del self.Data[key]
+            try:
+                writer = CacheWriter(self.Filename)
+                writer.Write(json.dumps(self.Data))
+                writer.Commit()
+                self.Dirty = False
+            except Exception as e:
+                Log.Debug("Storage - Flush() - Store '%s' write failed: '%s'" % (self.Filename, e))
+            self.Saved = now
+
+class CacheIndex():
+    def __init__(self, path):
+        self.Path = path
+        self.Lock = threading.Lock()
+        self.Entries = {}
+        self.Directories = set()
+        self.Touched = set()
+        self.Journal = 0
+        self.Size = 0
+        self.Load()
+
+    def Load(self):
+        if not os.path.isfile(self.Path): return
+        try:
+            with open(self.Path, "r") as file:
+                for line in file:
+                    self.Journal = self.Journal + 1
+                    try: entry = json.loads(line)
+                    except ValueError: continue
+                    if entry.get("removed"): self.Entries.pop(entry["key"], None)
+                    else: self.Entries[entry["key"]] = entry
+        except Exception as e:
+            Log.Debug("Storage - Load() - Index '%s' unreadable, starting empty: '%s'" % (self.Path, e))
+            self.Entries = {}
+        self.Size = sum(entry.get("size", 0) for entry in self.Entries.itervalues())
+        Log.Debug("Storage - Load() - Entries: '%s', Journal: '%s', Size: '%s'" % (len(self.Entries), self.Journal, self.Size))
+        if self.Journal > 2 * len(self.Entries) + constants.CacheIndexSlack:
+            self.Compact()
+
+    def Get(self, filename):
+        key = Key(filename)
+        entry = self.Entries.get(key)
+        if entry == None:
+            entry = self.Backfill(key)
+        return entry
+
+    def Lookup(self, filename):
+        key = Key(filename)
+        entry = self.Entries.get(key + constants.CacheCompressedSuffix) or self.Entries.get(key)
+        if entry == None:
+            entry = self.Backfill(key + constants.CacheCompressedSuffix) or self.Backfill(key)
+        return entry
+
+    def Backfill(self, key):
+        try: stat = os.stat(AbsolutePath(key))
+        except OSError: return None
+        return self.Set(key, fetched=stat.st_mtime, size=stat.st_size)
+
+    def Set(self, filename, **values):
+        key = Key(filename)
+        with self.Lock:
+            entry = dict(self.Entries.get(key, {}))
+            self.Size = self.Size - entry.get("size", 0)
+            entry.update(values)
+            entry["key"] = key
+            self.Size = self.Size + entry.get("size", 0)
+            self.Entries[key] = entry
+            self.Touched.discard(key)
+            self.Append(entry)
+        return entry
+
+    def Touch(self, filename):
+        key = Key(filename)
+        entry = self.Entries.get(key)
+        if entry != None:
+            entry["accessed"] = time()
+            self.Touched.add(key)
+
+    def Flush(self):
+        with self.Lock:
+            for key in list(self.Touched):
+                if key in self.Entries: self.Append(self.Entries[key])
+            self.Touched.clear()
+
+    def Remove(self, filename):
+        key = Key(filename)
+        with self.Lock:
+            entry = self.Entries.pop(key, None)
+            if entry != None:
+                self.Size = self.Size - entry.get("size", 0)
+                self.Touched.discard(key)
+                self.Append({"key": key, "removed": True})
+
+    def Append(self, entry):
+        try:
+            with open(self.Path, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+            self.Journal = self.Journal + 1
+        except Exception as e:
+            Log.Debug("Storage - Append() - Index '%s' write failed: '%s'" % (self.Path, e))
+
+    def Compact(self):
+        with self.Lock:
+            try:
+                with open(self.Path + ".tmp", "w") as file:
+                    for entry in self.Entries.itervalues():
+                        file.write(json.dumps(entry) + "\n")
+                ReplaceFile(self.Path + ".tmp", self.Path)
+                self.Journal = len(self.Entries)
+                Log.Debug("Storage - Compact() - Entries: '%s'" % (self.Journal))
+            except Exception as e:
+                Log.Debug("Storage - Compact() - Index '%s' compaction failed: '%s'" % (self.Path, e))
+
+    def EnsureDirectory(self, path):
+        if path in self.Directories: return
+        if not os.path.exists(path):
+            Log.Debug("Storage - EnsureDirectory() - dir: '%s'" % (path))
+            os.makedirs(path)
+        self.Directories.add(path)
+
+class CacheManager():
+    def __init__(self, index, limit):
+        self.Index = index
+        self.Limit = limit
+        self.Thread = None
+
+    def Start(self):
+        if self.Thread != None: return
+        self.Thread = threading.Thread(target=self.Run, name="AmsaCacheManager")
+        self.Thread.daemon = True
+        self.Thread.start()
+
+    def Run(self):
+        if not constants.CacheImportMarker in self.Index.Entries:
+            self.Import()
+        while True:
+            try:
+                self.Index.Flush()
+                for store in pStores: store.Flush()
+                self.Evict()
+                if self.Index.Journal > 2 * len(self.Index.Entries) + constants.CacheIndexSlack:
+                    self.Index.Compact()
+            except Exception as e:
+                Log.Debug("Storage - Run() - Exception: '%s'" % (e))
+            sleep(constants.CacheManagerInterval)
+
+    def Import(self):
+        # One-off pass over files cached before the index existed, batched so it never hogs the disk
+        count = 0
+        for root, dirs, files in os.walk(constants.CachePath):
+            for file in files:
+                key = Key(os.path.join(root, file))
+                if not key in self.Index.Entries and not file.endswith(".tmp") and file != constants.CacheIndexFile:
+                    self.Index.Backfill(key)
+                    count = count + 1
+                    if count % constants.CacheManagerBatch == 0: sleep(1)
+        self.Index.Set(constants.CacheImportMarker, size=0, fetched=time())
+        Log.Debug("Storage - Import() - Indexed '%s' existing files" % (count))
+
+    def Evict(self):
+        if self.Limit <= 0 or self.Index.Size <= self.Limit: return
+        target = self.Limit * constants.CacheEvictTarget
+        # Files directly under Cache are the reference lists, only entries in sub-directories are evicted
+        candidates = sorted([entry for entry in self.Index.Entries.values() if "/" in entry["key"][len(constants.CacheDirectory) + 1:]], key=lambda x: x.get("accessed", x.get("fetched", 0)))
+        evicted = 0
+        for entry in candidates[:constants.CacheManagerBatch]:
+            if self.Index.Size <= target: break
+            path = AbsolutePath(entry["key"])
+            try: os.remove(path)
+            except OSError: pass
+            self.Index.Remove(entry["key"])
+            try: os.removedirs(os.path.dirname(path))
+            except OSError: pass
+            evicted = evicted + 1
+        self.Index.Directories.clear()
+        Log.Debug("Storage - Evict() - Evicted: '%s', Size: '%s', Limit: '%s'" % (evicted, self.Index.Size, self.Limit))
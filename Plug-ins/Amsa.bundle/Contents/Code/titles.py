@@ -0,0 +1,289 @@
+import constants, functions, storage
+
+import difflib, hashlib, json, struct
+from array import array
+from time import time
+
+def Load(url, filename, cache, timeout):
+    source = storage.Index().Lookup(os.path.join(constants.CacheDirectory, filename))
+    digest = storage.SourceHash(source) if source and source["fetched"] > time() - cache else None
+    if digest:
+        index = LoadSnapshot(digest)
+        if index != None: return index
+    tree = functions.XMLFromURL(url, filename, "", cache, timeout)
+    if tree is None: return TitleIndex(TitleStore())
+    index = TitleIndex(TitleStore(tree))
+    source = storage.Index().Lookup(os.path.join(constants.CacheDirectory, filename))
+    digest = storage.SourceHash(source) if source else None
+    if digest: SaveSnapshot(index, digest)
+    return index
+
+
+def Trigrams(text):
+    return set(text[i:i + 3] for i in range(0, len(text) - 2))
+
+def LoadColumns(version):
+    entry = storage.Index().Lookup(constants.TitleColumnsFile)
+    if entry:
+        try:
+            with storage.Open(entry) as file: data = json.load(file)
+            if data.get("version") == version:
+                return data["clean"], data["filter"]
+        except Exception as e:
+            Log.Debug("Titles - LoadColumns() - '%s' unreadable: '%s'" % (entry["key"], e))
+    return None
+
+def SaveColumns(version, clean, filter):
+    try:
+        writer = storage.CacheWriter(constants.TitleColumnsFile, constants.CompressCache)
+        writer.Write(json.dumps({"version": version, "clean": clean, "filter": filter}))
+        writer.Commit()
+    except Exception as e:
+        Log.Debug("Titles - SaveColumns() - Saving failed: '%s'" % (e))
+
+def SaveSnapshot(index, source):
+    # Header, then length-prefixed sections, arrays stored raw so each one loads with a single copy
+    store = index.Store
+    keys = sorted(index.Trigrams.keys())
+    starts = array("i", [0])
+    postings = array("i")
+    for key in keys:
+        postings.extend(index.Trigrams[key])
+        starts.append(len(postings))
+    ranges = sorted(store.Ranges.items())
+    meta = json.dumps({"types": store.TypeNames, "langs": store.LangNames, "version": index.Version})
+    sections = [meta, store.Aids, store.Types, store.Langs, store.Offsets, store.Text.encode("utf-8"),
+                array("i", [aid for aid, bounds in ranges]), array("i", [bounds[0] for aid, bounds in ranges]), array("i", [bounds[1] for aid, bounds in ranges]),
+                index.Titles, index.Positions, "\n".join(index.Clean), "\n".join(index.Filter), "\n".join(keys), starts, postings]
+    try:
+        writer = storage.CacheWriter(constants.TitleSnapshotFile)
+        writer.Write(constants.TitleSnapshotMagic + struct.pack("<I32s", constants.TitleSnapshotVersion, source))
+        for section in sections:
+            if isinstance(section, array):
+                writer.Write(struct.pack("<cQ", section.typecode, len(section) * section.itemsize))
+                writer.Write(section.tostring())
+            else:
+                writer.Write(struct.pack("<cQ", "s", len(section)))
+                writer.Write(section)
+        writer.Commit()
+        Log.Debug("Titles - SaveSnapshot() - Source: '%s', Sections: '%s'" % (source, len(sections)))
+    except Exception as e:
+        Log.Debug("Titles - SaveSnapshot() - Saving failed: '%s'" % (e))
+
+def LoadSnapshot(source):
+    entry = storage.Index().Get(constants.TitleSnapshotFile)
+    if not entry: return None
+    try:
+        # Read rather than mapped, so no handle stays open and a rebuild can replace the file on Windows
+        with open(storage.AbsolutePath(entry["key"]), "rb") as file:
+            data = file.read()
+        header = len(constants.TitleSnapshotMagic)
+        version, digest = struct.unpack_from("<I32s", data, header)
+        if data[:header] != constants.TitleSnapshotMagic or version != constants.TitleSnapshotVersion or digest != source:
+            Log.Debug("Titles - LoadSnapshot() - Snapshot is out of date, rebuilding")
+            return None
+        offset = header + struct.calcsize("<I32s")
+        sections = []
+        while offset < len(data):
+            typecode, length = struct.unpack_from("<cQ", data, offset)
+            offset = offset + struct.calcsize("<cQ")
+            sections.append((typecode, offset, length))
+            offset = offset + length
+        values = []
+        for typecode, start, length in sections:
+            if typecode == "s":
+                values.append(data[start:start + length])
+            else:
+                values.append(array(typecode, data[start:start + length]))
+        del data
+        meta, aids, types, langs, offsets, text, rangeAids, rangeStarts, rangeEnds, titles, positions, clean, filter, keys, starts, postings = values
+        meta = json.loads(meta)
+
+        store = TitleStore()
+        store.Aids, store.Types, store.Langs, store.Offsets = aids, types, langs, offsets
+        store.TypeNames, store.LangNames = meta["types"], meta["langs"]
+        store.Text = text.decode("utf-8")
+        store.Ranges = dict((aid, (start, end)) for aid, start, end in zip(rangeAids, rangeStarts, rangeEnds))
+
+        index = TitleIndex(TitleStore())
+        index.Store = store
+        index.Titles, index.Positions, index.Version = titles, positions, meta["version"]
+        index.Clean = clean.split("\n") if clean else []
+        index.Filter = filter.split("\n") if filter else []
+        index.Trigrams = Postings(keys.split("\n") if keys else [], starts, postings)
+        Log.Debug("Titles - LoadSnapshot() - Titles: '%s', Trigrams: '%s'" % (len(index.Titles), len(index.Trigrams)))
+        return index
+    except Exception as e:
+        Log.Debug("Titles - LoadSnapshot() - '%s' unreadable: '%s'" % (entry["key"], e))
+        return None
+
+class Postings():
+    # Trigram directory over one flat postings array, a trigram's posting list is only sliced out when it is looked up
+    def __init__(self, keys, starts, postings):
+        self.Keys = dict((key, i) for i, key in enumerate(keys))
+        self.Starts = starts
+        self.Postings = postings
+
+    def __len__(self):
+        return len(self.Keys)
+
+    def get(self, trigram, default=None):
+        i = self.Keys.get(trigram)
+        if i == None: return default
+        return self.Postings[self.Starts[i]:self.Starts[i + 1]]
+
+class TitleStore():
+    # Parallel arrays of (aid, type, lang, text) with interned type/lang codes, the anime-titles DOM is not kept
+    def __init__(self, tree=None):
+        self.Aids = array("i")
+        self.Types = array("b")
+        self.Langs = array("h")
+        self.Offsets = array("i", [0])
+        self.TypeNames = []
+        self.LangNames = []
+        self.Ranges = {}
+        self.Text = u""
+        if tree != None: self.Build(tree)
+
+    def Build(self, tree):
+        typeCodes = {}
+        langCodes = {}
+        texts = []
+        length = 0
+        for anime in tree.iterchildren("anime"):
+            aid = int(anime.get("aid"))
+            start = len(self.Aids)
+            for title in anime.iterchildren("title"):
+                text = title.text or u""
+                self.Aids.append(aid)
+                self.Types.append(self.Code(title.get("type"), self.TypeNames, typeCodes))
+                self.Langs.append(self.Code(title.get(constants.XmlLang), self.LangNames, langCodes))
+                texts.append(text)
+                length = length + len(text)
+                self.Offsets.append(length)
+            self.Ranges[aid] = (start, len(self.Aids))
+        self.Text = u"".join(texts)
+        Log.Debug("Titles - TitleStore() - Anime: '%s', Titles: '%s'" % (len(self.Ranges), len(self.Aids)))
+
+    def Code(self, name, names, codes):
+        if not name in codes:
+            codes[name] = len(names)
+            names.append(name)
+        return codes[name]
+
+    def __len__(self):
+        return len(self.Aids)
+
+    def GetText(self, i):
+        return self.Text[self.Offsets[i]:self.Offsets[i + 1]]
+
+    def GetType(self, i):
+        return self.TypeNames[self.Types[i]]
+
+    def GetLang(self, i):
+        return self.LangNames[self.Langs[i]]
+
+    def ByAid(self, aid):
+        try: start, end = self.Ranges.get(int(aid), (0, 0))
+        except (TypeError, ValueError): return []
+        return [Title(self, i) for i in range(start, end)]
+
+class Title(object):
+    # Stands in for an anime-titles <title> element wherever only .text and .get() are used
+    __slots__ = ("Store", "Index")
+
+    def __init__(self, store, index):
+        self.Store = store
+        self.Index = index
+
+    @property
+    def text(self):
+        return self.Store.GetText(self.Index)
+
+    @property
+    def Aid(self):
+        return self.Store.Aids[self.Index]
+
+    def get(self, key, default=None):
+        if key == "type": return self.Store.GetType(self.Index)
+        if key == constants.XmlLang: return self.Store.GetLang(self.Index)
+        return default
+
+class TitleIndex():
+    def __init__(self, store):
+        self.Store = store
+        self.Titles = array("i")
+        self.Positions = array("i")
+        self.Clean = []
+        self.Filter = []
+        self.Trigrams = {}
+        self.Version = None
+        if len(store): self.Build()
+
+    def Build(self):
+        store = self.Store
+        self.Titles = array("i", [i for i in range(len(store)) if store.GetType(i) in constants.SearchTitleTypes])
+        self.Positions = array("i", [-1]) * len(store)
+        for i, title in enumerate(self.Titles): self.Positions[title] = i
+        texts = [store.GetText(title) for title in self.Titles]
+        self.Version = hashlib.md5((constants.Filter_Regex + u"\n" + u"\n".join(texts)).encode("utf-8")).hexdigest()
+        columns = LoadColumns(self.Version)
+        if columns:
+            self.Clean, self.Filter = columns
+        else:
+            Log.Debug("Titles - TitleIndex() - Cleaning titles for version '%s'" % (self.Version))
+            self.Clean = [functions.CleanTitle(text) for text in texts]
+            self.Filter = [functions.CleanTitle(text, True) for text in texts]
+            SaveColumns(self.Version, self.Clean, self.Filter)
+        self.Trigrams = {}
+        for i, clean in enumerate(self.Clean):
+            for trigram in Trigrams(clean):
+                if not trigram in self.Trigrams: self.Trigrams[trigram] = array("i")
+                self.Trigrams[trigram].append(i)
+        Log.Debug("Titles - TitleIndex() - Titles: '%s', Trigrams: '%s'" % (len(self.Titles), len(self.Trigrams)))
+
+    def CleanTitle(self, title, filter=False):
+        i = self.Positions[title.Index] if title.Index < len(self.Positions) else -1
+        if i < 0: return functions.CleanTitle(title.text, filter)
+        return self.Filter[i] if filter else self.Clean[i]
+
+    def Search(self, name):
+        name = name.lower()
+        if len(name) < 3:
+            matches = set(i for i, clean in enumerate(self.Clean) if name in clean)
+        else:
+            # Every title containing the name holds all of its trigrams, so the rarest one bounds the candidates
+            postings = min([self.Trigrams.get(trigram, ()) for trigram in Trigrams(name)], key=len)
+            matches = set(i for i in postings if name in self.Clean[i])
+        if not matches:
+            return [Title(self.Store, self.Titles[i]) for i in self.Fuzzy(name)]
+        return [Title(self.Store, self.Titles[i]) for i in sorted(matches)]
+
+    def Fuzzy(self, name, cutoff=constants.FuzzyCutoff):
+        # A ratio of at least cutoff needs 2 * min(len) / (len + len) >= cutoff, which bounds the candidate lengths
+        low, high = len(name) * cutoff / (2 - cutoff), len(name) * (2 - cutoff) / cutoff
+        lengths = [i for i, clean in enumerate(self.Clean) if low <= len(clean) <= high]
+        # One transposition can break every trigram, so no shared count is guaranteed at a usable cutoff,
+        # titles sharing trigrams are only tried first and the remaining lengths are scanned when none matches
+        counts = {}
+        for trigram in Trigrams(name):
+            for i in self.Trigrams.get(trigram, ()):
+                counts[i] = counts.get(i, 0) + 1
+        candidates = [i for i in lengths if i in counts]
+        matches = self.Verify(name, candidates, cutoff)
+        if not matches:
+            matches = self.Verify(name, [i for i in lengths if not i in counts], cutoff)
+        Log.Debug("Titles - Fuzzy() - Name: '%s', Candidates: '%s', Lengths: '%s', Matches: '%s'" % (name, len(candidates), len(lengths), len(matches)))
+        return matches
+
+    def Verify(self, name, candidates, cutoff):
+        # Matching candidates, best ratio first
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(name)
+        matches = []
+        for i in candidates:
+            matcher.set_seq1(self.Clean[i])
+            if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+                ratio = matcher.ratio()
+                if ratio >= cutoff: matches.append((-ratio, i))
+        return [i for ratio, i in sorted(matches)]
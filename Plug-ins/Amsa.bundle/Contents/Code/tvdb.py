@@ -31,6 +31,7 @@ class TvDB(constants.Series):
             ##--------------------------------Originally_Available_At--------------##     
             if GetElementText(data, "Series/FirstAired"):
                 self.Originally_Available_At = GetElementText(data, "Series/FirstAired")
+            functions.SetStartDate("tvdb", id, startdate=GetElementText(data, "Series/FirstAired"))
                 
             ##--------------------------------Rating-------------------------------##     
             if GetElementText(data, "Series/Rating"):    
@@ -5,6 +5,8 @@ import os                                               # path, listdir
 import tempfile                                         # NamedTemporaryFile
 import time                                             # strftime
 import re                                               # match, compile, sub
+import json                                             # load
+import hashlib                                          # md5
 from lxml import etree                                  # fromstring
 import Utils                                            # SplitPath
 import VideoFiles                                       # VideoFiles.Scan(path, files, mediaList, subdirs, None) # Scan for video files.
@@ -17,6 +19,8 @@ ASS_MAPPING_URL           = 'https://raw.githubusercontent.com/ZeroQI/Absolute-S
 ANIDB_TVDB_MAPPING        = 'https://raw.githubusercontent.com/Anime-Lists/anime-lists/master/anime-list-master.xml'
 ANIDB_TVDB_MAPPING_MOD    = 'https://raw.githubusercontent.com/Dingmatt/AMSA/master/Plug-in%20Support/Data/com.plexapp.agents.amsa/DataItems/Cache/anime-list-corrections.xml'
 ANIDB_TVDB_MAPPING_CUSTOM = 'anime-list-custom.xml'                                                                            # custom local correction for ScudLee mapping file url
+ANIDB_TVDB_MAPPING_INDEX  = 'anime-list-index.json'                                                                            # master + corrections merged by the AMSA agent into its DataItems/Cache folder
+ANIDB_TVDB_MAPPING_INDEX_VERSION, ANIDB_TVDB_MAPPING_INDEX_AGE, ANIDB_TVDB_MAPPING_INDEX_LOCK = 1, 172800, 300                  # agent artifact format, max source age and stale lock age in seconds
 SOURCE_IDS                = ".*? ?\[(anidb|anidb2|tvdb|tvdb2|tvdb3|tvdb4|tvdb5|tmdb|tsdb|imdb)-(tt)?[0-9]{1,7}-?(s[0-9]{1,3})?(e[0-9]{1,3})?\]"
 SOURCE_ID_FILES           = ["anidb.id", "anidb2.id", "tvdb.id", "tvdb2.id", "tvdb3.id", "tvdb4.id", "tvdb5.id", "tmdb.id", "tsdb.id", "imdb.id"]
 TVDB_MODE_IDS             = ".*?\[tvdb(?P<mode>(2|3|4|5))-(tt)?(?P<guid>[0-9]{1,7})(-s[0-9]{1,3}(e[0-9]{1,3})?)?\]"
@@ -121,6 +125,7 @@ if not os.path.isdir(LOG_PATH):
                     'Linux':   '$PLEX_HOME/Library/Application Support/Plex Media Server' }
   try:  path = os.path.expandvars(path_location[Platform.OS.lower()] if Platform.OS.lower() in path_location else '~')  # Platform.OS:  Windows, MacOSX, or Linux
   except: pass #os.makedirs(LOG_PATH)  # User folder on MacOS-X
+AMSA_CACHE_PATH = os.path.abspath(os.path.join(os.path.dirname(inspect.getfile(inspect.currentframe())), "..", "..", "Plug-in Support", "Data", "com.plexapp.agents.amsa", "DataItems", "Cache"))
 LOG_FILE_LIBRARY = LOG_FILE = 'Plex Media Scanner (custom ASS).log'                # Log filename library will include the library name, LOG_FILE not and serve as reference
 set_logging("Root", LOG_FILE_LIBRARY)
 PLEX_LIBRARY, PLEX_LIBRARY_URL = {}, "http://127.0.0.1:32400/library/sections/"    # Allow to get the library name to get a log per library https://support.plex.tv/hc/en-us/articles/204059436-Finding-your-account-token-X-Plex-Token
@@ -235,12 +240,12 @@ def add_episode_into_plex(mediaList, file, root, path, show, season=1, ep=1, tit
   ep_orig, ep_orig_padded = "s%de%d%s" % (season, ep, "" if not ep2 or ep==ep2 else "-%s" % ep2), "s%02de%02d%s" % (season, ep, "" if not ep2 or ep==ep2 else "-%02d" % ep2)
   ep_orig_single          = "s%de%d"   % (season, ep)
   if ep_orig_single in mappingList:
-    multi_ep   = 0 if ep_orig == ep_orig_single else ep2-ep
-    season, ep = mappingList[ep_orig_single][1:].split("e")
-    if '-' in ep or  '+' in ep:  ep, ep2 = ep.split("+"); ep2 = int(ep2) if ep2 and ep2.isdigit() else None
-    season, ep, ep2 = int(season), int(ep), int(ep)+multi_ep if multi_ep else ep2
+    multi_ep      = 0 if ep_orig == ep_orig_single else ep2-ep
+    season, eps   = mappingList[ep_orig_single]
+    ep, ep2       = eps[0], eps[1] if len(eps) > 1 else ep2
+    if multi_ep:  ep2 = ep+multi_ep
     
-  elif 's%d' % season in mappingList and int(mappingList['s%d' % season][0])<=ep and ep<=int(mappingList['s%d' % season][1]):  ep, season = ep + int (mappingList['s%d' % season][2]), int(mappingList['s%d' % season][3])
+  elif 's%d' % season in mappingList and mappingList['s%d' % season][0]<=ep and ep<=mappingList['s%d' % season][1]:  ep, season = ep + mappingList['s%d' % season][2], mappingList['s%d' % season][3]
   elif season > 0:  season, ep, ep2 = season+offset_season if offset_season >= 0 else 0, ep+offset_episode, ep2+offset_episode if ep2 else None
   
   if title==title.lower() or title==title.upper() and title.count(" ")>0: title           = title.title()       # capitalise if all caps or all lowercase and one space at least
@@ -269,20 +274,52 @@ def add_episode_into_plex(mediaList, file, root, path, show, season=1, ep=1, tit
   
 ### Get the tvdbId from the AnimeId #######################################################################################################################
 def anidbTvdbMapping(AniDB_TVDB_mapping_tree, anidbid):
-  mappingList                  = {}
-  for anime in AniDB_TVDB_mapping_tree.iter('anime') if AniDB_TVDB_mapping_tree else []:
-    if anime.get("anidbid") == anidbid and anime.get('tvdbid').isdigit():
-      mappingList['episodeoffset'] = anime.get('episodeoffset')
-      try:
-        for season in anime.iter('mapping'):
-          if season.get("offset"):  mappingList[ 's'+season.get("anidbseason")] = [season.get("start"), season.get("end"), season.get("offset"), season.get("tvdbseason")]
-          for string2 in filter(None, season.text.split(';')) if season.text else []:  mappingList[ 's'+season.get("anidbseason") + 'e' + string2.split('-')[0] ] = 's' + season.get("tvdbseason") + 'e' + string2.split('-')[1] 
-      except: Log.error("anidbTvdbMapping() - mappingList creation exception, mappingList: '%s'" % (str(mappingList)))
-      else:   Log.info("anidbTvdbMapping() - anidb: '%s', tvbdid: '%s', defaulttvdbseason: '%s', name: '%s', mappingList: '%s'" % (anidbid, anime.get('tvdbid'), anime.get('defaulttvdbseason'), anime.xpath("name")[0].text, str(mappingList)) )
-      return anime.get('tvdbid'), anime.get('defaulttvdbseason'), mappingList
+  for anime in AniDB_TVDB_mapping_tree.iter('anime') if AniDB_TVDB_mapping_tree is not None else []:
+    if anime.get("anidbid") == anidbid and (anime.get('tvdbid') or '').isdigit():
+      return anidbTvdbMappingList(anidbid, anime.attrib, [(season.attrib, season.text) for season in anime.iter('mapping')], anime.findtext("name"))
   Log.error("anidbTvdbMapping() - No valid tvbdbid: found for anidbid '%s'" % (anidbid))
   return "", "", {}
 
+### Parse an anime entry once into mappingList: 'sXeY' -> (tvdb season, [tvdb eps]), 'sX' -> (start, end, offset, tvdb season) ###
+def anidbTvdbMappingList(anidbid, anime, seasons, name=None):
+  episodeoffset = anime.get('episodeoffset') or ''
+  mappingList   = {'episodeoffset': int(episodeoffset) if episodeoffset.lstrip('-').isdigit() else 0}
+  for season, text in seasons:
+    try:
+      if season.get("offset"):  mappingList[ 's'+season.get("anidbseason")] = (int(season.get("start")), int(season.get("end")), int(season.get("offset")), int(season.get("tvdbseason")))
+      for string2 in filter(None, text.split(';')) if text else []:
+        anidb_ep, tvdb_eps = string2.split('-', 1)
+        mappingList[ 's'+season.get("anidbseason") + 'e' + anidb_ep ] = (int(season.get("tvdbseason")), [int(tvdb_ep) for tvdb_ep in tvdb_eps.split('+')])
+    except: Log.error("anidbTvdbMappingList() - mappingList creation exception, season: '%s', text: '%s'" % (str(season), text))
+  Log.info("anidbTvdbMappingList() - anidb: '%s', tvbdid: '%s', defaulttvdbseason: '%s', name: '%s', mappingList: '%s'" % (anidbid, anime.get('tvdbid'), anime.get('defaulttvdbseason'), name, str(mappingList)) )
+  return anime.get('tvdbid'), anime.get('defaulttvdbseason'), mappingList
+
+### Load the AMSA agent mapping index (anidbid -> (anime, seasons)) if not locked and built from the current cached source files ###
+MAPPING_INDEX = None
+def anidbTvdbMappingIndex():
+  global MAPPING_INDEX
+  if MAPPING_INDEX is not None:  return MAPPING_INDEX
+  index_filename = os.path.join(AMSA_CACHE_PATH, ANIDB_TVDB_MAPPING_INDEX)
+  try:
+    if os.path.exists(index_filename+'.lock') and int(time.time() - os.path.getmtime(index_filename+'.lock')) <= ANIDB_TVDB_MAPPING_INDEX_LOCK:
+      Log.info("anidbTvdbMappingIndex() - Index being written by the agent: '%s'" % index_filename);  return None
+    hashes = []
+    for url in (ANIDB_TVDB_MAPPING, ANIDB_TVDB_MAPPING_MOD):
+      source = os.path.join(AMSA_CACHE_PATH, os.path.basename(url))
+      if os.path.exists(source+'.gz'):  source += '.gz'
+      if int(time.time() - os.path.getmtime(source)) > ANIDB_TVDB_MAPPING_INDEX_AGE:
+        Log.info("anidbTvdbMappingIndex() - Source file out of date: '%s'" % source);  return None
+      with open(source, 'rb') as source_file:  hashes.append(hashlib.md5(source_file.read()).hexdigest())
+    with open(index_filename, 'rb') as index_file:  index = json.load(index_file)
+    if index.get('version') != "%s-%s" % (ANIDB_TVDB_MAPPING_INDEX_VERSION, "-".join(hashes)):
+      Log.info("anidbTvdbMappingIndex() - Index version '%s' does not match the source files" % index.get('version'));  return None
+  except Exception as e:  Log.info("anidbTvdbMappingIndex() - Index unavailable: '%s', Exception: '%s'" % (index_filename, e));  return None
+  MAPPING_INDEX = {}
+  for anime, seasons in index['entries']:
+    if (anime.get('tvdbid') or '').isdigit():  MAPPING_INDEX.setdefault(anime.get('anidbid'), (anime, seasons))
+  Log.info("anidbTvdbMappingIndex() - Loaded: '%s', entries: '%s'" % (index_filename, len(MAPPING_INDEX)))
+  return MAPPING_INDEX
+
 ### Look for episodes ###################################################################################
 def Scan(path, files, mediaList, subdirs, language=None, root=None, **kwargs): #get called for root and each root folder
   global LOG_FILE_LIBRARY
@@ -418,7 +455,7 @@ def Scan(path, files, mediaList, subdirs, language=None, root=None, **kwargs): #
         tvdbanime = etree.fromstring( urlopen(tvdb_guid_url).read() )
         for episode in tvdbanime.xpath('Episode'):
           if episode.xpath('SeasonNumber')[0].text != '0' and episode.xpath('absolute_number')[0].text:
-            mappingList['s%se%s'%(episode.xpath('SeasonNumber')[0].text, episode.xpath('EpisodeNumber')[0].text)] = "s1e%s" % episode.xpath('absolute_number')[0].text
+            mappingList['s%se%s'%(episode.xpath('SeasonNumber')[0].text, episode.xpath('EpisodeNumber')[0].text)] = (1, [int(episode.xpath('absolute_number')[0].text)])
         Log.info("mappingList: '%s'" % str(mappingList))
       except Exception as e:  Log.error("xml loading issue, Exception: '%s''" % e)
     if tvdb_mapping: Log.info("unknown_series_length: %s, tvdb_mapping: %s" % (unknown_series_length, str(tvdb_mapping)))
@@ -453,8 +490,14 @@ def Scan(path, files, mediaList, subdirs, language=None, root=None, **kwargs): #
             break
       dir = os.path.dirname(dir)
       
+    # AMSA agent index of ANIDB_TVDB_MAPPING_MOD over ANIDB_TVDB_MAPPING, download both below if unavailable
+    mapping_index = anidbTvdbMappingIndex() if not a2_tvdbid else None
+    if mapping_index is not None:
+      if anidb_id in mapping_index:  a2_tvdbid, a2_defaulttvdbseason, mappingList = anidbTvdbMappingList(anidb_id, *mapping_index[anidb_id])
+      else:                          Log.error("anidbTvdbMappingIndex() - No valid tvbdbid: found for anidbid '%s'" % (anidb_id))
+      
     # Online mod mapping file = ANIDB_TVDB_MAPPING_MOD 
-    if not a2_tvdbid:
+    if not a2_tvdbid and mapping_index is None:
       tmp_file         = tempfile.NamedTemporaryFile(delete=False); tmp_filename = tmp_file.name; tmp_file.close()
       scudlee_filename = tmp_filename.replace(os.path.basename(tmp_filename), 'anime-list-corrections.xml')
       try:
@@ -475,7 +518,7 @@ def Scan(path, files, mediaList, subdirs, language=None, root=None, **kwargs): #
         except Exception as e:  Log.error("Error parsing ScudLee's file mod content, Exception: '%s'" % e)
     
     #ANIDB_TVDB_MAPPING
-    if not a2_tvdbid:
+    if not a2_tvdbid and mapping_index is None:
       tmp_file         = tempfile.NamedTemporaryFile(delete=False); tmp_filename = tmp_file.name; tmp_file.close()
       scudlee_filename = tmp_filename.replace(os.path.basename(tmp_filename), 'ASS-tmp-anime-list-master.xml')
       try:
@@ -499,8 +542,7 @@ def Scan(path, files, mediaList, subdirs, language=None, root=None, **kwargs): #
     if a2_tvdbid:
       folder_show    = clean_string(folder_show)+" [tvdb-%s]" % a2_tvdbid
       offset_season  = int(a2_defaulttvdbseason)-1 if a2_defaulttvdbseason and a2_defaulttvdbseason.isdigit() else 0
-      if 'episodeoffset' in mappingList and mappingList['episodeoffset']:  offset_episode = 0-int(mappingList['episodeoffset'][1:]) if mappingList['episodeoffset'].startswith('-') else int(mappingList['episodeoffset'])
-      else:                                                                offset_episode = 0
+      offset_episode = mappingList.get('episodeoffset', 0)
       
   if tvdb_mode_search or anidb2_match:  Log.info("".ljust(157, '-'))
   